@@ -0,0 +1,125 @@
+"""
+Convert a feature h5 file into a raw memory-mapped array plus a small json index,
+to be read by the DataLoader with --feat_backend mmap
+
+The array is written row-major from offset 0 of its own file (page aligned),
+so that all loaders and jobs on one host share the same OS page cache.
+
+With --gl_blocks, only the given blocks of a global-local feature file are kept,
+so that the loader reads and copies just the columns it trains on.
+"""
+
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# blocks of the global-local feature vector, in their stored order, with their sizes
+GL_BLOCKS = [('long', 300), ('short', 400), ('local', 1000)]
+
+
+def to_str(i):
+    return i.decode() if isinstance(i, bytes) else str(i)
+
+
+def sort_ids(ids):
+    if all(i.isdigit() for i in ids):
+        return sorted(ids, key=int)
+    return sorted(ids)
+
+
+def main(feat_h5, output_prefix, chunk_size, label_h5=None, gl_blocks=None):
+    data_file = output_prefix + '.bin'
+    index_file = output_prefix + '.json'
+
+    with h5py.File(feat_h5, 'r') as f:
+        keyed = 'feats' not in f
+        if not keyed:
+            # one dataset, one row per video
+            ids = [to_str(i) for i in f['ids'][()]] if 'ids' in f else None
+            feats = f['feats']
+            shape = feats.shape
+            dtype = feats.dtype
+        else:
+            # one dataset per video, keyed by the video id ('mp1' files)
+            ids = sort_ids(list(f.keys()))
+            shape = (len(ids),) + f[ids[0]].shape
+            dtype = f[ids[0]].dtype
+
+        if ids is None and label_h5:
+            # without ids, the row of a video is its id minus the first id of the split
+            # (the offsets the DataLoader falls back to), whatever the order of the
+            # videos in the label file
+            with h5py.File(label_h5, 'r') as lf:
+                ids = sort_ids([to_str(i) for i in lf['videos'][()]])
+            assert len(ids) == shape[0], 'got %d videos for %d feature rows' % (len(ids), shape[0])
+            assert all(i.isdigit() for i in ids) and int(ids[-1]) - int(ids[0]) + 1 == len(ids), \
+                'the videos of %s are not a contiguous range of ids, cannot map them to the feature rows' % label_h5
+
+        cols = None
+        if gl_blocks:
+            assert shape[-1] == sum(size for _, size in GL_BLOCKS), \
+                'expected global-local features of size %d, got %d' % (sum(size for _, size in GL_BLOCKS), shape[-1])
+            gl_blocks = [name for name, _ in GL_BLOCKS if name in gl_blocks]
+            cols = []
+            offset = 0
+            for name, size in GL_BLOCKS:
+                if name in gl_blocks:
+                    cols.extend(range(offset, offset + size))
+                offset += size
+            cols = np.array(cols)
+            shape = shape[:-1] + (len(cols),)
+
+        logger.info('Writing array of size %s (%s) to: %s', repr(shape), dtype, data_file)
+        out = np.memmap(data_file, dtype=dtype, mode='w+', shape=shape)
+        for start in range(0, shape[0], chunk_size):
+            end = min(start + chunk_size, shape[0])
+            if keyed:
+                chunk = np.stack([f[i][()] for i in ids[start:end]])
+            else:
+                chunk = feats[start:end]
+            out[start:end] = chunk if cols is None else chunk[..., cols]
+        out.flush()
+        del out
+
+    index = {'data_file': os.path.basename(data_file),
+             'dtype': np.dtype(dtype).str,
+             'shape': list(shape),
+             'ids': ids,
+             'source': os.path.basename(feat_h5)}
+    if gl_blocks:
+        index['blocks'] = gl_blocks
+
+    logger.info('Writing index to: %s', index_file)
+    json.dump(index, open(index_file, 'w'))
+
+
+######################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--feat_h5', type=str, help='input feature h5 file')
+    parser.add_argument('--output_prefix', default=None, help='output prefix of the .bin/.json pair; default: the input file without .h5, as expected by the DataLoader')
+    parser.add_argument('--label_h5', default=None, help='optional sequencelabel h5 of the same split, whose video ids are recorded for the feature rows when the h5 has no ids dataset (rows ordered by video id from the first one of the split)')
+    parser.add_argument('--gl_blocks', nargs='+', default=None, choices=[name for name, _ in GL_BLOCKS],
+                        help='keep only these blocks of a global-local feature file (e.g. long short); default: copy all columns')
+    parser.add_argument('--chunk_size', default=1024, type=int, help='number of videos copied at a time')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    start = datetime.now()
+
+    output_prefix = args.output_prefix or os.path.splitext(args.feat_h5)[0]
+    main(args.feat_h5, output_prefix, args.chunk_size, label_h5=args.label_h5, gl_blocks=args.gl_blocks)
+
+    logger.info('Time: %s', datetime.now() - start)
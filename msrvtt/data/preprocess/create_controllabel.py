@@ -0,0 +1,61 @@
+"""
+Read the noun/verb control ids of the training captions from the train list pickle
+(one (video, noun[, verb]) tuple per caption, in the order of the sequence labels)
+Save them as int8 arrays aligned with the `labels` rows of the sequencelabel h5 file
+"""
+
+import os
+import argparse
+import h5py
+import numpy as np
+from six.moves import cPickle
+
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def main(train_list, label_h5, output_h5):
+    logger.info('Loading: %s', train_list)
+    with open(train_list, 'rb') as f:
+        control_list = cPickle.load(f)
+
+    controls = np.array([c[1:] for c in control_list], dtype=np.int8)
+    videos = np.array([c[0] for c in control_list])
+    names = ['noun', 'verb'][:controls.shape[1]]
+
+    with h5py.File(label_h5, 'r') as f:
+        assert controls.shape[0] == f['labels'].shape[0], \
+            'got %d control ids for %d captions' % (controls.shape[0], f['labels'].shape[0])
+        if 'label_to_video' in f:
+            assert np.all(videos == f['label_to_video'][()]), 'control ids are not aligned with the captions'
+
+    # write into the sequencelabel file itself unless a sidecar file is given
+    with h5py.File(output_h5 or label_h5, 'a' if output_h5 is None else 'w') as of:
+        for i, name in enumerate(names):
+            if name in of:
+                del of[name]
+            of.create_dataset(name, dtype=np.int8, data=controls[:, i])
+            logger.info('Wrote %d %s ids to %s', controls.shape[0], name, output_h5 or label_h5)
+
+
+######################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s:%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--train_list', type=str, help='pickled list of (video, noun[, verb]) tuples, one per training caption')
+    parser.add_argument('--label_h5', type=str, help='_sequencelabel.h5 file of the training split')
+    parser.add_argument('--output_h5', default=None, help='optional sidecar h5 file; default: add the datasets to --label_h5')
+
+    args = parser.parse_args()
+    logger.info('Input parameters: %s', args)
+
+    start = datetime.now()
+
+    main(args.train_list, args.label_h5, args.output_h5)
+
+    logger.info('Time: %s', datetime.now() - start)
@@ -8,12 +8,83 @@ import numpy as np
 import random
 import time
 import cPickle
+import threading
+import collections
+import torch.utils.data
+from six.moves import queue
 
 import logging
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# blocks of the global-local feature vector, in their stored order, with their sizes
+GL_BLOCKS = [('long', 300), ('short', 400), ('local', 1000)]
+
+
+def to_str(i):
+    return i.decode() if isinstance(i, bytes) else str(i)
+
+
+def read_rows(dataset, rows, bulk=True):
+    """Read `rows` of a h5 dataset, returned in the requested order.
+    In bulk mode the rows are sorted and fetched with a single fancy-indexed
+    call (h5py requires increasing indices), then scattered back into place.
+    """
+    if not bulk:
+        return np.stack([dataset[row] for row in rows])
+    uniq_rows, inverse = np.unique(np.asarray(rows), return_inverse=True)
+    return dataset[uniq_rows.tolist()][inverse]
+
+
+def sample_captions(ncaps, seq_per_img):
+    """Pick `seq_per_img` caption indices for every video, given the number of
+    captions `ncaps` of each video: all of them in order, topped up with random
+    ones when there are not enough, otherwise a random subset without replacement.
+    Returns a (len(ncaps) x seq_per_img) index matrix.
+    """
+    ncaps = np.asarray(ncaps)[:, np.newaxis]
+    q = np.arange(seq_per_img)[np.newaxis, :]
+    cap_ix = np.where(q < ncaps, q, (np.random.rand(ncaps.shape[0], seq_per_img) * ncaps).astype(int))
+
+    many = ncaps[:, 0] > seq_per_img
+    if many.any():
+        # random permutations of each row, invalid positions are sorted last
+        keys = np.random.rand(many.sum(), ncaps.max())
+        keys[np.arange(keys.shape[1])[np.newaxis, :] >= ncaps[many]] = 2
+        cap_ix[many] = np.argsort(keys, axis=1)[:, :seq_per_img]
+    return cap_ix
+
+
+class MmapFeatFile(object):
+    """Read-only, h5py.File-like view over a feature store converted by
+    data/preprocess/convert_feats2mmap.py (a raw array file plus a json index).
+    Rows are read straight from the OS page cache, which is shared by all the
+    loaders and jobs reading the same store.
+    """
+
+    def __init__(self, index_file):
+        index = json.load(open(index_file))
+        data_file = os.path.join(os.path.dirname(index_file), index['data_file'])
+        self.feats = np.memmap(data_file, dtype=np.dtype(str(index['dtype'])), mode='r', shape=tuple(index['shape']))
+        self.ids = index.get('ids')
+        self.id_to_row = {str(i): row for row, i in enumerate(self.ids)} if self.ids is not None else {}
+        self.attrs = {'blocks': index['blocks']} if 'blocks' in index else {}
+
+    def __getitem__(self, key):
+        if key == 'feats':
+            return self.feats
+        return self.feats[self.id_to_row[str(key)]]
+
+    def __contains__(self, key):
+        return key == 'feats' or str(key) in self.id_to_row
+
+    def keys(self):
+        return ['feats'] + list(self.id_to_row.keys())
+
+    def close(self):
+        self.feats = None
+
 
 class DataLoader():
     """Class to load video features and captions"""
@@ -40,6 +111,10 @@ class DataLoader():
         self.use_short_range = opt.get('use_short_range', 0)
         self.use_local = opt.get('use_local', 0)
 
+        self.bulk_read = opt.get('bulk_read', 1)
+        self.feat_backend = opt.get('feat_backend', 'h5')
+        self.bucket_batches = opt.get('bucket_batches', 0)
+
         # open the hdf5 info file
         logger.info('DataLoader loading h5 file: %s', opt['label_h5'])
         self.label_h5 = h5py.File(opt['label_h5'], 'r')
@@ -53,15 +128,18 @@ class DataLoader():
 
         # load the json file which contains additional information about the dataset
         self.feat_h5_files = opt['feat_h5']
-        logger.info('DataLoader loading h5 files: %s', self.feat_h5_files)
+        logger.info('DataLoader loading %s files: %s', self.feat_backend, self.feat_h5_files)
+        self.open_feat_files()
+
+        # resolve the feature row of every video once
         if self.use_resnet_feature == 1:
-            self.feat_h5_res = h5py.File(self.feat_h5_files[0], 'r')
+            self.feat_rows_res = self.get_feat_rows(self.feat_h5_res, self.feat_h5_files[0])
         if self.use_c3d_feature == 1:
-            self.feat_h5_c3d = h5py.File(self.feat_h5_files[1], 'r')
+            self.feat_rows_c3d = self.get_feat_rows(self.feat_h5_c3d, self.feat_h5_files[1])
         if self.use_audio_feature == 1:
-            self.feat_h5_aud = h5py.File(self.feat_h5_files[2], 'r')
+            self.feat_rows_aud = self.get_feat_rows(self.feat_h5_aud, self.feat_h5_files[2])
         if self.use_global_local_feature == 1:
-            self.feat_h5_gl = h5py.File(self.feat_h5_files[3], 'r')
+            self.feat_rows_gl = self.get_feat_rows(self.feat_h5_gl, self.feat_h5_files[3])
 
         self.feat_dims = []
         if self.use_resnet_feature == 1:
@@ -71,13 +149,9 @@ class DataLoader():
         if self.use_audio_feature == 1:
             self.feat_dim_aud = self.feat_h5_aud[self.videos[0]].shape[0] if 'mp1' in self.feat_h5_files[2] else self.feat_h5_aud['feats'][0].shape[0]
         if self.use_global_local_feature == 1:
-            self.feat_dim_gl = 0
-            if self.use_long_range:
-                self.feat_dim_gl += 300
-            if self.use_short_range:
-                self.feat_dim_gl += 400
-            if self.use_local:
-                self.feat_dim_gl += 1000
+            self.gl_blocks = [name for (name, _), use in zip(GL_BLOCKS, [self.use_long_range, self.use_short_range, self.use_local]) if use]
+            self.gl_cols = self.get_gl_cols(self.feat_h5_gl)
+            self.feat_dim_gl = sum(size for name, size in GL_BLOCKS if name in self.gl_blocks)
 
         if self.use_resnet_feature == 1:
             self.feat_dims.append(self.feat_dim_res)
@@ -98,18 +172,29 @@ class DataLoader():
         if self.use_global_local_feature == 0:
             self.num_feats = self.num_feats - 1
 
+        # the files are opened again by the process that reads the first batch (the
+        # worker processes of a WorkerBatchLoader), none are inherited across fork
+        self.close_feat_files()
+
         # load in the sequence data
         if 'labels' in self.label_h5.keys():
             self.seq_length = self.label_h5['labels'].shape[1]
             logger.info('max sequence length in data is: %d', self.seq_length)
 
-            # load the pointers in full to RAM (should be small enough)
-            self.label_start_ix = self.label_h5['label_start_ix']
-            self.label_end_ix = self.label_h5['label_end_ix']
+            # load the labels and the pointers in full to RAM (should be small enough),
+            # the labels are kept as uint16 when the vocab fits and are widened per batch
+            label_dtype = np.uint16 if len(self.vocab) <= np.iinfo(np.uint16).max + 1 else np.int64
+            self.labels = np.empty(self.label_h5['labels'].shape, dtype=label_dtype)
+            self.label_h5['labels'].read_direct(self.labels)
+            self.label_start_ix = self.label_h5['label_start_ix'][()].astype(np.int32)
+            self.label_end_ix = self.label_h5['label_end_ix'][()].astype(np.int32)
+            if 'label_length' in self.label_h5:
+                self.label_length = self.label_h5['label_length'][()].astype(np.int32)
             assert (self.label_start_ix.shape[0] == self.label_end_ix.shape[0])
             self.has_label = True
         else:
             self.has_label = False
+        self.label_h5.close()
 
         if self.bcmrscores_pkl is not None:
             eval_metric = opt.get('eval_metric', 'CIDEr')
@@ -119,33 +204,62 @@ class DataLoader():
                 eval_metric = 'cider'
             self.bcmrscores = self.bcmrscores[eval_metric]
 
+        if self.mode == 'train' and self.bucket_batches > 0:
+            self.video_length = self.get_video_lengths()
+            logger.info('Bucketing the training videos by caption length, %d batches per bucket', self.bucket_batches)
+
         if self.mode == 'train':
             self.shuffle_videos()
         #---添加代码----
         if self.mode == 'train':
-            vidlist=[]
-            nounlist=[]
-            verblist=[]
-            with open('msrvtt_train_list', 'rb') as f:
-                self.msvd_my_list = cPickle.load(f)
-            for (k,v,j) in self.msvd_my_list:
-                vidlist.append(k)
-                nounlist.append(v)
-                verblist.append(j)
-            self.vidlist=vidlist
-            self.nounlist=nounlist
-            self.verblist=verblist
+            # noun/verb control ids, one per caption (see data/preprocess/create_controllabel.py)
+            control_h5 = opt.get('control_h5') or opt['label_h5']
+            logger.info('DataLoader loading control labels: %s', control_h5)
+            with h5py.File(control_h5, 'r') as f:
+                assert 'noun' in f and 'verb' in f, 'No control labels in %s, please run data/preprocess/create_controllabel.py' % control_h5
+                self.nouns = f['noun'][()]
+                self.verbs = f['verb'][()]
+            assert self.nouns.shape[0] == self.labels.shape[0]
+
     def __del__(self):
+        if getattr(self, 'pid', None) is not None:
+            self.close_feat_files()
+
+    def open_feat_files(self):
+        """Open the feature files in this process. h5py handles cannot be shared
+        with forked processes, so the loader holds none after its construction and
+        each process opens its own before its first read (see load_batch).
+        """
+        self.pid = os.getpid()
+        if self.use_resnet_feature == 1:
+            self.feat_h5_res = self.open_feat_file(self.feat_h5_files[0])
+        if self.use_c3d_feature == 1:
+            self.feat_h5_c3d = self.open_feat_file(self.feat_h5_files[1])
+        if self.use_audio_feature == 1:
+            self.feat_h5_aud = self.open_feat_file(self.feat_h5_files[2])
+        if self.use_global_local_feature == 1:
+            self.feat_h5_gl = self.open_feat_file(self.feat_h5_files[3])
+
+    def close_feat_files(self):
+        self.pid = None
         if self.use_resnet_feature == 1:
             self.feat_h5_res.close()
+            self.feat_h5_res = None
         if self.use_c3d_feature == 1:
             self.feat_h5_c3d.close()
+            self.feat_h5_c3d = None
         if self.use_audio_feature == 1:
             self.feat_h5_aud.close()
+            self.feat_h5_aud = None
         if self.use_global_local_feature == 1:
             self.feat_h5_gl.close()
+            self.feat_h5_gl = None
 
-        self.label_h5.close()
+    def open_feat_file(self, filename):
+        if self.feat_backend == 'mmap':
+            # the store converted from foo.h5 is foo.json + foo.bin
+            return MmapFeatFile(os.path.splitext(filename)[0] + '.json')
+        return h5py.File(filename, 'r')
 
     def update_index(self, video_id, filename):
         if self.cocofmt_file.find("msrvtt") != -1:
@@ -167,7 +281,76 @@ class DataLoader():
 
         return releative_id
 
+    def get_feat_rows(self, feat_h5, filename):
+        """Row of every video in the 'feats' array of a feature file, taken from the
+        video ids stored with the features ('ids' dataset or mmap index) when
+        available, otherwise from the dataset split offsets.
+        Returns None for files with one dataset per video ('mp1' files).
+        """
+        ids = getattr(feat_h5, 'ids', None)
+        if ids is None:
+            if 'mp1' in filename:
+                return None
+            if 'ids' not in feat_h5:
+                logger.info('No video ids in %s, using the dataset split offsets', filename)
+                return np.array([self.update_index(int(video), filename) for video in self.videos])
+            ids = feat_h5['ids'][()]
+
+        id_to_row = {int(i): row for row, i in enumerate(ids)}
+        return np.array([id_to_row[int(video)] for video in self.videos])
+
+    def get_gl_cols(self, feat_h5):
+        """Columns of the selected global-local blocks in the rows of feat_h5, as a slice
+        when they are contiguous (no copy). Stores pre-sliced by convert_feats2mmap.py
+        list the blocks they hold in their 'blocks' attribute.
+        """
+        stored = [to_str(b) for b in feat_h5.attrs['blocks']] if 'blocks' in feat_h5.attrs else [name for name, _ in GL_BLOCKS]
+        missing = [name for name in self.gl_blocks if name not in stored]
+        assert not missing, 'global-local features %s do not hold the %s block(s)' % (self.feat_h5_files[3], ', '.join(missing))
+
+        cols = []
+        offset = 0
+        for name, size in GL_BLOCKS:
+            if name not in stored:
+                continue
+            if name in self.gl_blocks:
+                cols.extend(range(offset, offset + size))
+            offset += size
+        cols = np.array(cols, dtype=np.int64)
+        if len(cols) > 0 and cols[-1] - cols[0] == len(cols) - 1:
+            return slice(int(cols[0]), int(cols[-1]) + 1)
+        return cols
+
+    def read_feats(self, feat_h5, feat_rows, idxs):
+        """Read the features of the videos `idxs` from one feature file, in batch order"""
+        if feat_rows is None:
+            # one dataset per video, keyed by the video id
+            return np.stack([np.array(feat_h5[str(int(self.videos[idx]))]) for idx in idxs])
+        return read_rows(feat_h5['feats'], feat_rows[idxs], self.bulk_read)
+
     def get_batch(self):
+        return self.load_batch(self.next_batch_idxs())
+
+    def next_batch_idxs(self):
+        """Advance the iterator by one batch, returning the indices of its videos"""
+        idxs = []
+        for ii in range(self.batch_size):
+            idxs.append(self.index[self.iterator])
+            self.iterator += 1
+            if self.iterator >= self.num_videos:
+                logger.info('===> Finished loading epoch %d', self.epoch)
+                self.iterator = 0
+                self.epoch += 1
+                if self.mode == 'train':
+                    # the rest of this batch comes from the new epoch
+                    self.shuffle_videos(offset=self.batch_size - len(idxs))
+        return idxs
+
+    def load_batch(self, idxs):
+        """Read the features and sample the captions of the videos `idxs`"""
+        if self.pid != os.getpid():
+            self.open_feat_files()
+
         video_batchs = []
         if self.use_resnet_feature == 1:
             video_batch_res = torch.FloatTensor(self.batch_size, self.num_chunks, 20, self.feat_dim_res).zero_()
@@ -187,142 +370,72 @@ class DataLoader():
         if self.use_global_local_feature == 1:
             video_batchs.append(video_batch_gl)
 
-        if self.has_label:
-            label_batch = torch.LongTensor(self.batch_size * self.seq_per_img, self.seq_length).zero_()
-            mask_batch = torch.FloatTensor(self.batch_size * self.seq_per_img, self.seq_length).zero_()
-            #--------noun----------
-            if self.mode == 'train':
-                noun_batch = torch.LongTensor(self.batch_size * self.seq_per_img).zero_()
-                verb_batch = torch.LongTensor(self.batch_size * self.seq_per_img).zero_()
-
-
-        videoids_batch = []
         gts = []
         bcmrscores = np.zeros((self.batch_size, self.seq_per_img)) if self.bcmrscores_pkl is not None else None
 
-        for ii in range(self.batch_size):
-            idx = self.index[self.iterator]
-            video_id = int(self.videos[idx])
-            videoids_batch.append(video_id)
-
-            feat_idx = 0
-
-            if self.use_resnet_feature == 1:
-                if 'mp1' in self.feat_h5_files[0]:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(np.array(self.feat_h5_res[str(video_id)]))
-                else:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(
-                        np.array(self.feat_h5_res['feats'][self.update_index(video_id, self.feat_h5_files[0])]))
-                feat_idx += 1
-
-            if self.use_c3d_feature == 1:
-                if 'mp1' in self.feat_h5_files[1]:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(np.array(self.feat_h5_c3d[str(video_id)]))
-                else:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(np.array(self.feat_h5_c3d['feats'][self.update_index(video_id, self.feat_h5_files[1])]))
-                feat_idx += 1
-
-            if self.use_audio_feature == 1:
-                if 'mp1' in self.feat_h5_files[2]:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(np.array(self.feat_h5_aud[str(video_id)]))
-                else:
-                    video_batchs[feat_idx][ii] = torch.from_numpy(np.array(self.feat_h5_aud['feats'][self.update_index(video_id, self.feat_h5_files[2])]))
-                feat_idx += 1
+        videoids_batch = [int(self.videos[idx]) for idx in idxs]
 
-            if self.use_global_local_feature == 1:
-                if 'mp1' in self.feat_h5_files[3]:
-                    loaded_data = torch.from_numpy(np.array(self.feat_h5_gl[str(video_id)]))
-                else:
-                    loaded_data = torch.from_numpy(np.array(self.feat_h5_gl['feats'][self.update_index(video_id, self.feat_h5_files[3])]))
-
-                global_local_feature = torch.FloatTensor([])
-
-                if self.use_long_range:
-                    global_local_feature = torch.cat((global_local_feature, loaded_data[:300]), -1)
+        feat_idx = 0
+        if self.use_resnet_feature == 1:
+            video_batchs[feat_idx][:] = torch.from_numpy(self.read_feats(self.feat_h5_res, self.feat_rows_res, idxs)).unsqueeze(1)
+            feat_idx += 1
 
-                if self.use_short_range:
-                    global_local_feature = torch.cat((global_local_feature, loaded_data[300:(300+400)]), -1)
+        if self.use_c3d_feature == 1:
+            video_batchs[feat_idx][:] = torch.from_numpy(self.read_feats(self.feat_h5_c3d, self.feat_rows_c3d, idxs)).unsqueeze(1)
+            feat_idx += 1
 
-                if self.use_local:
-                    global_local_feature = torch.cat((global_local_feature, loaded_data[(300+400):(300+400+1000)]), -1)
+        if self.use_audio_feature == 1:
+            video_batchs[feat_idx][:] = torch.from_numpy(self.read_feats(self.feat_h5_aud, self.feat_rows_aud, idxs)).unsqueeze(1)
+            feat_idx += 1
 
+        if self.use_global_local_feature == 1:
+            loaded_gl = self.read_feats(self.feat_h5_gl, self.feat_rows_gl, idxs)
 
-                video_batchs[feat_idx][ii] = global_local_feature
+            video_batchs[feat_idx][:] = torch.from_numpy(loaded_gl[:, self.gl_cols]).unsqueeze(1)
+            feat_idx += 1
 
-                feat_idx += 1
+        if self.has_label:
+            label_start_ix = self.label_start_ix[idxs]
+            label_end_ix = self.label_end_ix[idxs]
+            ncaps = label_end_ix - label_start_ix  # number of captions available for each video
+            assert (ncaps > 0).all(), 'No captions!!'
 
+            # Used for reward evaluation
+            gts = [self.labels[ix1:ix2] for ix1, ix2 in zip(label_start_ix, label_end_ix)]
 
-            if self.has_label:
-                # fetch the sequence labels
-                ix1 = self.label_start_ix[idx]
-                ix2 = self.label_end_ix[idx]
-                ncap = ix2 - ix1  # number of captions available for this image
-                assert ncap > 0, 'No captions!!'
+            # gather the seq_per_img captions of every video at once
+            rows = (label_start_ix[:, np.newaxis] + sample_captions(ncaps, self.seq_per_img)).reshape(-1)
+            seq = self.labels[rows]
 
-                seq = torch.LongTensor(self.seq_per_img, self.seq_length).zero_()
-                seq_all = torch.from_numpy(np.array(self.label_h5['labels'][ix1:ix2]))
-                #--------noun-------------------------
-                if self.mode == 'train':
-                    noun = torch.LongTensor(self.seq_per_img).zero_()
-                    noun_all = torch.from_numpy(np.array(self.nounlist[ix1:ix2]))
-                    verb = torch.LongTensor(self.seq_per_img).zero_()
-                    verb_all = torch.from_numpy(np.array(self.verblist[ix1:ix2]))
-                #-------------------------------------
-                if ncap <= self.seq_per_img:
-                    seq[:ncap] = seq_all[:ncap]
-                    # -----添加----
-                    if self.mode == 'train':
-                        noun[:ncap] = noun_all[:ncap]
-                        verb[:ncap] = verb_all[:ncap]
-                    for q in range(ncap, self.seq_per_img):
-                        ixl = np.random.randint(ncap)
-                        seq[q] = seq_all[ixl]
-                        # --------noun---------
-                        if self.mode == 'train':
-                            noun[q] = noun_all[ixl]
-                            verb[q] = verb_all[ixl]
-                else:
-                    randpos = torch.randperm(ncap)
-                    for q in range(self.seq_per_img):
-                        ixl = randpos[q]
-                        seq[q] = seq_all[ixl]
-                        # ------noun------------
-                        if self.mode == 'train':
-                            noun[q] = noun_all[ixl]
-                            verb[q] = verb_all[ixl]
-
-                il = ii * self.seq_per_img
-                label_batch[il:il + self.seq_per_img] = seq
-                #-------noun---------
-                if self.mode == 'train':
-                    noun_batch[il:il + self.seq_per_img] = noun
-                    verb_batch[il:il + self.seq_per_img] = verb
+            # + 1 here to count the <eos> token, because the <eos> token is set to 0
+            nonzeros = (seq != 0).sum(1) + 1
+
+            width = self.seq_length
+            if self.bucket_batches > 0:
+                # drop the padding columns shared by the whole batch, keeping one all-zero
+                # column so that teacher-forced decoding stops at the same step as on
+                # untrimmed labels (the model pads them back for sampled inputs)
+                width = min(width, nonzeros.max() + 1)
+                seq = seq[:, :width]
+            label_batch = torch.from_numpy(seq.astype(np.int64))
+            mask_batch = torch.from_numpy((np.arange(width) < nonzeros[:, np.newaxis]).astype(np.float32))
 
-                # Used for reward evaluation
-                gts.append(self.label_h5['labels'][self.label_start_ix[idx]: self.label_end_ix[idx]])
+            #--------noun----------
+            if self.mode == 'train':
+                noun_batch = torch.from_numpy(self.nouns[rows]).long()
+                verb_batch = torch.from_numpy(self.verbs[rows]).long()
 
-                # pre-computed cider scores, 
-                # assuming now that videos order are same (which is the sorted videos order)
-                if self.bcmrscores_pkl is not None:
+            # pre-computed cider scores, 
+            # assuming now that videos order are same (which is the sorted videos order)
+            if self.bcmrscores_pkl is not None:
+                for ii, idx in enumerate(idxs):
                     bcmrscores[ii] = self.bcmrscores[idx]
-            self.iterator += 1
-            if self.iterator >= self.num_videos:
-                logger.info('===> Finished loading epoch %d', self.epoch)
-                self.iterator = 0
-                self.epoch += 1
-                if self.mode == 'train':
-                    self.shuffle_videos()
 
         data = {}
         data['feats'] = video_batchs
         data['ids'] = videoids_batch
 
         if self.has_label:
-            # + 1 here to count the <eos> token, because the <eos> token is set to 0
-            nonzeros = np.array(list(map(lambda x: (x != 0).sum() + 1, label_batch)))
-            for ix, row in enumerate(mask_batch):
-                row[:nonzeros[ix]] = 1
-
             data['labels'] = label_batch
             data['masks'] = mask_batch
             data['gts'] = gts
@@ -342,12 +455,25 @@ class DataLoader():
     def set_current_index(self, index):
         self.iterator = index
 
+    def get_video_order(self):
+        """Copy of the order of the videos in the current epoch"""
+        return list(self.index)
+
+    def set_video_order(self, index):
+        self.index = list(index)
+
     def get_vocab(self):
         return self.ix_to_word
 
     def get_vocab_size(self):
         return len(self.vocab)
 
+    def get_word_counts(self):
+        """Number of occurrences of each word in the captions, <eos> once per caption"""
+        counts = np.bincount(self.labels.ravel(), minlength=len(self.vocab))
+        counts[0] = self.labels.shape[0]
+        return counts
+
     def get_feat_dims(self):
         return self.feat_dims
 
@@ -375,8 +501,228 @@ class DataLoader():
     def set_current_epoch(self, epoch):
         self.epoch = epoch
 
-    def shuffle_videos(self):
+    def get_video_lengths(self):
+        """Longest caption length of every video, by which the videos are bucketed:
+        with seq_per_img captions drawn per video, the longest one is nearly always
+        in the batch and sets its trimmed width (see load_batch)
+        """
+        caption_length = self.label_length if hasattr(self, 'label_length') else (self.labels != 0).sum(1)
+        # the maximum over the rows label_start_ix ... label_end_ix - 1 of each video,
+        # read at the even positions of the interleaved (start, end) boundaries
+        bounds = np.stack([self.label_start_ix, self.label_end_ix], 1).reshape(-1)
+        return np.maximum.reduceat(np.append(caption_length, 0), bounds)[::2]
+
+    def shuffle_videos(self, offset=0):
+        """Shuffle the videos of the next epoch. With bucket_batches, the videos after
+        the first `offset` ones (which complete the batch that crosses the epoch end)
+        are grouped into batches of similar caption length.
+        """
         np.random.shuffle(self.index)
+        if self.bucket_batches > 0:
+            self.index[offset:] = self.bucket_index(np.array(self.index[offset:])).tolist()
+
+    def bucket_index(self, index):
+        """Sort each run of bucket_batches batches of the shuffled `index` by caption
+        length, then shuffle the order of the full batches. A trailing partial batch
+        is kept last, so that it is completed by the next epoch.
+        """
+        bucket_size = self.batch_size * self.bucket_batches
+        index = np.concatenate([bucket[np.argsort(self.video_length[bucket], kind='mergesort')]
+                                for bucket in np.split(index, np.arange(bucket_size, len(index), bucket_size))])
+        num_full = len(index) // self.batch_size * self.batch_size
+        batches = index[:num_full].reshape(-1, self.batch_size)
+        batches = batches[np.random.permutation(batches.shape[0])]
+        return np.concatenate([batches.reshape(-1), index[num_full:]])
 
     def get_cocofmt_file(self):
         return self.cocofmt_file
+
+
+class BatchPrefetcher(object):
+    """Wraps a DataLoader and builds its next `num_batches` batches in a
+    background thread, through a bounded queue.
+
+    The epoch, iterator and video order reported by the wrapper are those of
+    the last batch handed out, not those of the producer, so that epoch
+    boundaries are detected through get_current_epoch() exactly as with the
+    bare loader. Every other attribute is forwarded to the wrapped loader.
+    """
+
+    def __init__(self, loader, num_batches):
+        self.loader = loader
+        self.num_batches = num_batches
+        self.thread = None
+        self.epoch = loader.get_current_epoch()
+        self.iterator = loader.get_current_index()
+        self.index = loader.get_video_order()
+        self.wait_time = 0.
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def produce(self, batches, stop_event):
+        epoch = self.loader.get_current_epoch()
+        while not stop_event.is_set():
+            try:
+                data = self.loader.get_batch()
+                # the videos are reshuffled when an epoch ends
+                order = self.loader.get_video_order() if self.loader.get_current_epoch() != epoch else None
+                epoch = self.loader.get_current_epoch()
+                item = (data, epoch, self.loader.get_current_index(), order)
+            except Exception as e:
+                item = e
+            while not stop_event.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
+
+    def start(self):
+        self.batches = queue.Queue(maxsize=self.num_batches)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.produce, args=(self.batches, self.stop_event))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the producer and rewind the loader to the last batch handed out"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.loader.set_current_epoch(self.epoch)
+        self.loader.set_current_index(self.iterator)
+        self.loader.set_video_order(self.index)
+
+    def get_batch(self):
+        if self.thread is None:
+            self.start()
+        t_start = time.time()
+        item = self.batches.get()
+        self.wait_time += time.time() - t_start
+        if isinstance(item, Exception):
+            self.stop()
+            raise item
+        data, self.epoch, self.iterator, order = item
+        if order is not None:
+            self.index = order
+        return data
+
+    def pop_wait_time(self):
+        """Time spent waiting for batches (queue starvation) since the last call"""
+        wait_time, self.wait_time = self.wait_time, 0.
+        return wait_time
+
+    def reset(self):
+        self.stop()
+        self.loader.reset()
+        self.iterator = self.loader.get_current_index()
+
+    def get_current_index(self):
+        return self.iterator
+
+    def set_current_index(self, index):
+        self.stop()
+        self.loader.set_current_index(index)
+        self.iterator = index
+
+    def get_current_epoch(self):
+        return self.epoch
+
+    def set_current_epoch(self, epoch):
+        self.stop()
+        self.loader.set_current_epoch(epoch)
+        self.epoch = epoch
+
+
+def seed_worker(worker_id):
+    # torch seeds each worker with its own seed drawn from the main process,
+    # derive the numpy and python seeds (caption sampling) from it
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+    random.seed(torch.initial_seed())
+
+
+class VideoDataset(torch.utils.data.Dataset):
+    """Map-style dataset over the videos of a DataLoader. Items are video indices;
+    `collate` builds the batch in the worker process with DataLoader.load_batch, so
+    that it is read with the same batched calls and has the same content as the
+    output of get_batch().
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return self.loader.get_num_videos()
+
+    def __getitem__(self, idx):
+        return idx
+
+    def collate(self, idxs):
+        return self.loader.load_batch(idxs)
+
+
+class LoaderBatchSampler(torch.utils.data.Sampler):
+    """Endless batch sampler drawing the batches from the DataLoader iterator
+    (shuffling, bucketing and epochs included), in the main process. The epoch and
+    iterator after every batch (and the new video order after an epoch end) are
+    queued, to be popped as the batches come back.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.states = collections.deque()
+
+    def __iter__(self):
+        epoch = self.loader.get_current_epoch()
+        while True:
+            idxs = self.loader.next_batch_idxs()
+            order = self.loader.get_video_order() if self.loader.get_current_epoch() != epoch else None
+            epoch = self.loader.get_current_epoch()
+            self.states.append((epoch, self.loader.get_current_index(), order))
+            yield idxs
+
+
+class WorkerBatchLoader(BatchPrefetcher):
+    """Wraps a DataLoader and builds its batches in `num_workers` processes, with
+    torch.utils.data.DataLoader over a VideoDataset. As with BatchPrefetcher, the
+    epoch, iterator and video order reported are those of the last batch handed out.
+    """
+
+    def __init__(self, loader, num_workers):
+        super(WorkerBatchLoader, self).__init__(loader, 2 * num_workers)
+        self.num_workers = num_workers
+        self.batches = None
+
+    def start(self):
+        self.sampler = LoaderBatchSampler(self.loader)
+        dataset = VideoDataset(self.loader)
+        self.batches = iter(torch.utils.data.DataLoader(dataset,
+                                                        batch_sampler=self.sampler,
+                                                        num_workers=self.num_workers,
+                                                        collate_fn=dataset.collate,
+                                                        worker_init_fn=seed_worker))
+
+    def stop(self):
+        """Shut the workers down and rewind the loader to the last batch handed out"""
+        if self.batches is None:
+            return
+        self.batches = None
+        self.loader.set_current_epoch(self.epoch)
+        self.loader.set_current_index(self.iterator)
+        self.loader.set_video_order(self.index)
+
+    def get_batch(self):
+        if self.batches is None:
+            self.start()
+        t_start = time.time()
+        data = next(self.batches)
+        self.wait_time += time.time() - t_start
+        self.epoch, self.iterator, order = self.sampler.states.popleft()
+        if order is not None:
+            self.index = order
+        return data
@@ -1,8 +1,12 @@
 # -*- coding: UTF-8 -*-
+import copy
+import json
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 
@@ -13,6 +17,22 @@ def to_contiguous(tensor):
         return tensor.contiguous()
 
 
+def expand_rows(x, num_rows):
+    """Repeat every row of x for the num_rows / x.size(0) consecutive rows it stands for"""
+    if x.size(0) == num_rows:
+        return x
+    n = num_rows // x.size(0)
+    return x.unsqueeze(1).expand(x.size(0), n, x.size(1)).contiguous().view(num_rows, x.size(1))
+
+
+def add_rows(x, y):
+    """x + y, each row of y being shared by x.size(0) / y.size(0) consecutive rows of x,
+    without materializing the repeated rows of y"""
+    if x.size(0) == y.size(0):
+        return x + y
+    return (x.view(y.size(0), -1, x.size(1)) + y.unsqueeze(1)).view(x.size())
+
+
 class RewardCriterion(nn.Module):
 
     def __init__(self):
@@ -51,63 +71,85 @@ class CrossEntropyCriterion(nn.Module):
         output = torch.sum(output) / torch.sum(mask)
 
         return output
-#------------------新增加-------------------
-class CrossEntropyCriterion2(nn.Module):
-
-    def __init__(self):
-        super(CrossEntropyCriterion2, self).__init__()
-
-    def forward(self, pred, target, mask):
-        # truncate to the same size
-        target = target[:, :pred.size(1)]
-        mask = mask[:, :pred.size(1)]
-
-        pred = to_contiguous(pred).view(-1, pred.size(2))
-        target = to_contiguous(target).view(-1, 1)
-        mask = to_contiguous(mask).view(-1, 1)
-
-        output = -pred.gather(1, target) * mask
-        output = torch.sum(output) / torch.sum(mask)
-
-        return output
-class CrossEntropyCriterion3(nn.Module):
 
-    def __init__(self):
-        super(CrossEntropyCriterion3, self).__init__()
 
-    def forward(self, pred, target, mask):
-        # truncate to the same size
-        target = target[:, :pred.size(1)]
-        mask = mask[:, :pred.size(1)]
+def stream_chunk_loss(hidden, target, weights, logit_weight, logit_bias):
+    nll = F.cross_entropy(F.linear(hidden, logit_weight, logit_bias), target, reduction='none')
+    return torch.sum(nll * weights)
 
-        pred = to_contiguous(pred).view(-1, pred.size(2))
-        target = to_contiguous(target).view(-1, 1)
-        mask = to_contiguous(mask).view(-1, 1)
 
-        output = -pred.gather(1, target) * mask
-        output = torch.sum(output) / torch.sum(mask)
+class MultiStreamCriterion(nn.Module):
+    """
+    Sum over the control streams of weights[s] times the masked cross-entropy of
+    CrossEntropyCriterion, from the S x B x L x H hidden states of the streams
+    (see CaptionModel.forward with return_hidden) and the logit layer. Only the
+    unmasked tokens are projected, chunk_size rows at a time, and the logits of
+    a chunk are recomputed in the backward pass rather than kept, so the
+    S x B x L x V log probabilities are never materialized.
+
+    The weights are given per stream, or as a tensor of one weight per stream and
+    caption (S x B).
+
+    With num_sampled > 0, training uses a sampled softmax: the words are scored
+    against the words of the batch plus num_sampled words drawn from the
+    unigram^0.75 distribution of word_counts, instead of the whole vocabulary.
+    """
 
-        return output
+    def __init__(self, chunk_size=2048, num_sampled=0, word_counts=None):
+        super(MultiStreamCriterion, self).__init__()
+        self.chunk_size = chunk_size
+        self.num_sampled = num_sampled
+        if num_sampled > 0:
+            probs = np.power(np.asarray(word_counts, dtype=np.float64), 0.75)
+            self.register_buffer('sampling_probs', torch.from_numpy(probs / probs.sum()).float())
+
+    def sample_candidates(self, target):
+        """Candidate words of a sampled softmax: the words of `target`, always
+        kept, and the drawn ones. Returns them with the positions of `target`
+        among them and the logQ correction of their logits, the log expected
+        count of the words that are only drawn.
+        """
+        sampled = torch.multinomial(self.sampling_probs, self.num_sampled, replacement=True)
+        candidates = torch.unique(torch.cat([target, sampled]))
 
-class CrossEntropyCriterion4(nn.Module):
+        position = target.new_zeros(self.sampling_probs.size(0))
+        position[candidates] = torch.arange(candidates.size(0), dtype=torch.long, device=candidates.device)
+        in_target = self.sampling_probs.new_zeros(self.sampling_probs.size(0))
+        in_target[target] = 1
 
-    def __init__(self):
-        super(CrossEntropyCriterion4, self).__init__()
+        expected_count = (self.num_sampled * self.sampling_probs[candidates]).clamp(min=1e-10)
+        correction = torch.log(expected_count) * (1 - in_target[candidates])
+        return candidates, position[target], correction
 
-    def forward(self, pred, target, mask):
+    def forward(self, hidden, logit, target, mask, weights):
+        num_streams, batch_size, num_steps, hidden_size = hidden.size()
         # truncate to the same size
-        target = target[:, :pred.size(1)]
-        mask = mask[:, :pred.size(1)]
-
-        pred = to_contiguous(pred).view(-1, pred.size(2))
-        target = to_contiguous(target).view(-1, 1)
-        mask = to_contiguous(mask).view(-1, 1)
+        target = to_contiguous(target[:, :num_steps]).view(-1)
+        mask = to_contiguous(mask[:, :num_steps]).view(-1)
+
+        # the unmasked tokens, the same in every stream
+        keep = mask.data.nonzero().view(-1)
+        target = target.index_select(0, keep).repeat(num_streams)
+        weights = weights if torch.is_tensor(weights) else mask.new_tensor(weights).view(-1, 1)
+        weights = weights.expand(num_streams, batch_size).unsqueeze(2).expand(-1, -1, num_steps)
+        weights = to_contiguous(weights).view(num_streams, -1).index_select(1, keep) * mask.index_select(0, keep).view(1, -1) / torch.sum(mask)
+        hidden = to_contiguous(hidden).view(num_streams, -1, hidden_size).index_select(1, keep).view(-1, hidden_size)
+        weights = weights.view(-1)
+
+        logit_weight, logit_bias = logit.weight, logit.bias
+        if self.training and self.num_sampled > 0:
+            candidates, target, correction = self.sample_candidates(target)
+            logit_weight = logit_weight.index_select(0, candidates)
+            logit_bias = logit_bias.index_select(0, candidates) - correction
+
+        output = 0
+        for start in range(0, hidden.size(0), self.chunk_size):
+            end = start + self.chunk_size
+            output = output + checkpoint(stream_chunk_loss, hidden[start:end], target[start:end], weights[start:end],
+                                         logit_weight, logit_bias)
+        return output
 
-        output = -pred.gather(1, target) * mask
-        output = torch.sum(output) / torch.sum(mask)
 
-        return output
-#--------------------------------------------------
 class FeatPool(nn.Module):
 
     def __init__(self, feat_dims, out_size, dropout):
@@ -147,13 +189,7 @@ class FeatExpander(nn.Module):
         self.n = n
 
     def forward(self, x):
-        if self.n == 1:
-            out = x
-        else:
-            out = Variable(x.data.new(self.n * x.size(0), x.size(1)), volatile=x.volatile)
-            for i in range(x.size(0)):
-                out[i * self.n:(i + 1) * self.n] = x[i].expand(self.n, x.size(1))
-        return out
+        return expand_rows(x, self.n * x.size(0))
 
     def set_n(self, x):
         self.n = x
@@ -175,10 +211,44 @@ class RNNUnit(nn.Module):
 
         self.rnn = getattr(nn, self.rnn_type.upper())(self.input_size, self.rnn_size, self.num_layers, bias=False, dropout=self.drop_prob_lm)
 
+        # one-layer concat cores can step the cell by hand, with the video part of
+        # the input projection computed once per video (see video_gates and step)
+        self.word_size = opt.input_encoding_size
+        self.factorized = opt.factorized_core == 1 and opt.model_type == 'concat' and self.num_layers == 1
+
     def forward(self, xt, state):
         output, state = self.rnn(xt.unsqueeze(0), state)
         return output.squeeze(0), state
 
+    def forward_seq(self, xs, state):
+        """Run over a whole (packed) T x N x D input sequence at once"""
+        return self.rnn(xs, state)
+
+    def video_gates(self, fc_feats):
+        """Video part W_v . fc_feats of the gate pre-activations, the same at every step"""
+        return F.linear(fc_feats, self.rnn.weight_ih_l0[:, self.word_size:])
+
+    def step(self, xt, video_gates, state):
+        """Same as forward on [xt, fc_feats], given video_gates(fc_feats)"""
+        gates_x = add_rows(F.linear(xt, self.rnn.weight_ih_l0[:, :self.word_size]), video_gates)
+        if self.rnn_type == 'lstm':
+            h, c = state[0][0], state[1][0]
+            i, f, g, o = (gates_x + F.linear(h, self.rnn.weight_hh_l0)).chunk(4, 1)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            return h, (h.unsqueeze(0), c.unsqueeze(0))
+
+        h = state[0]
+        if self.rnn_type == 'gru':
+            r_x, z_x, n_x = gates_x.chunk(3, 1)
+            r_h, z_h, n_h = F.linear(h, self.rnn.weight_hh_l0).chunk(3, 1)
+            r = torch.sigmoid(r_x + r_h)
+            z = torch.sigmoid(z_x + z_h)
+            h = (1 - z) * torch.tanh(n_x + r * n_h) + z * h
+        else:
+            h = torch.tanh(gates_x + F.linear(h, self.rnn.weight_hh_l0))
+        return h, h.unsqueeze(0)
+
 
 class MANet(nn.Module):
     """
@@ -285,6 +355,7 @@ class CaptionModel(nn.Module):
         self.bos_index = 1  # index of the <bos> token
         self.ss_prob = 0
         self.mixer_from = 0
+        self.fuse_streams = opt.fuse_streams
 
         self.use_resnet_feature = opt.use_resnet_feature
         self.use_c3d_feature = opt.use_c3d_feature
@@ -301,6 +372,8 @@ class CaptionModel(nn.Module):
         self.video_encoding_size = self.num_feats * self.num_layers * self.rnn_size
         opt.video_encoding_size = self.video_encoding_size
         self.core = RNNUnit(opt)
+        # only the factorized step adds the per-video rows without expanding them
+        self.lazy_expand = opt.lazy_expand == 1 and self.core.factorized
 
         if self.model_type == 'manet':
             self.manet = MANet(self.video_encoding_size, self.rnn_size, self.num_feats)
@@ -322,6 +395,14 @@ class CaptionModel(nn.Module):
         """
         self.mixer_from = t
 
+    def length_control(self, seq):
+        """Length control id (1-3) of the captions seq"""
+        length = (seq != 0).sum(dim=-1).to(torch.long)
+        length_1 = (length <= 6).to(torch.long)
+        length_2 = ((length >= 7) & (length <= 12)).to(torch.long)
+        length_3 = ((length >= 13) & (length <= 22)).to(torch.long)
+        return length_1 * 1 + length_2 * 2 + length_3 * 3
+
     def set_seq_per_img(self, x):
         self.seq_per_img = x
         self.feat_expander.set_n(x)
@@ -332,51 +413,108 @@ class CaptionModel(nn.Module):
         self.logit.bias.data.fill_(0)
         self.logit.weight.data.uniform_(-initrange, initrange)
 
-    def init_hidden(self, batch_size):
+    def init_hidden(self, batch_size, lazy=False):
+        """Zero state of batch_size rows; with lazy, one row broadcast to all of them
+        without a copy, for the factorized step (see lazy_expand)"""
         weight = next(self.parameters()).data
+        num_rows = 1 if lazy else batch_size
 
         if self.rnn_type == 'lstm':
             return (
-                Variable(weight.new(self.num_layers, batch_size, self.rnn_size).zero_()),
-                Variable(weight.new(self.num_layers, batch_size, self.rnn_size).zero_()))
+                Variable(weight.new(self.num_layers, num_rows, self.rnn_size).zero_()).expand(self.num_layers, batch_size, self.rnn_size),
+                Variable(weight.new(self.num_layers, num_rows, self.rnn_size).zero_()).expand(self.num_layers, batch_size, self.rnn_size))
+        else:
+            return Variable(weight.new(self.num_layers, num_rows, self.rnn_size).zero_()).expand(self.num_layers, batch_size, self.rnn_size)
+
+    def get_input(self, seq, token_idx, logprobs_prev):
+        """Word fed at step token_idx: the ground truth, or a word sampled from the
+        previous output (scheduled sampling / MIXER)
+        """
+        if self.training and token_idx >= 1 and self.ss_prob > 0.0:
+            sample_prob = logprobs_prev.data.new(seq.size(0)).uniform_(0, 1)
+            sample_mask = sample_prob < self.ss_prob
+            if sample_mask.sum() == 0:
+                it = seq[:, token_idx].clone()
+            else:
+                sample_ind = sample_mask.nonzero().view(-1)
+                it = seq[:, token_idx].data.clone()
+                # fetch prev distribution: shape Nx(M+1)
+                prob_prev = torch.exp(logprobs_prev.data)
+                sample_ind_tokens = torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind)
+                it.index_copy_(0, sample_ind, sample_ind_tokens)
+                it = Variable(it, requires_grad=False)
+        elif self.training and self.mixer_from > 0 and token_idx >= self.mixer_from:
+            prob_prev = torch.exp(logprobs_prev.data)
+            it = torch.multinomial(prob_prev, 1).view(-1)
+            it = Variable(it, requires_grad=False)
         else:
-            return Variable(weight.new(self.num_layers, batch_size, self.rnn_size).zero_())
+            it = seq[:, token_idx].clone()
+        return it
 
-    def forward(self, feats, seq, noun, verb):#---noun and verb--
+    def core_step(self, xt, fc_feats, video_gates, state):
+        """Step of a concat core on [xt, fc_feats]. With the cached video_gates of
+        a factorized core, only the word part of the input is projected. fc_feats
+        and video_gates may hold one row per video (see lazy_expand).
+        """
+        if video_gates is None:
+            return self.core(torch.cat([xt, expand_rows(fc_feats, xt.size(0))], 1), state)
+        return self.core.step(xt, video_gates, state)
+
+    def forward(self, feats, seq, noun, verb, return_hidden=False, streams=None, length=None):#---noun and verb--
 
         # for feat in feats:
         #     print(feat.size())
 
         fc_feats = self.feat_pool(feats)
-        fc_feats = self.feat_expander(fc_feats)
+        # projected before the expansion, once per video
+        video_gates = self.core.video_gates(fc_feats) if self.core.factorized else None
+        if not self.lazy_expand:
+            video_gates = self.feat_expander(video_gates) if video_gates is not None else None
+            fc_feats = self.feat_expander(fc_feats)
+        # else the rows of a video are broadcast to its seq_per_img captions where used
 
-        batch_size = fc_feats.size(0)
-        state = self.init_hidden(batch_size)
+        if self.training and (self.ss_prob > 0 or self.mixer_from > 0) and seq.size(1) < self.seq_length:
+            # sampled words may run past the longest caption of labels trimmed by the
+            # loader (see bucket_batches): decode up to seq_length as on full rows
+            seq = torch.cat([seq, seq.new_zeros(seq.size(0), self.seq_length - seq.size(1))], 1)
+
+        batch_size = seq.size(0)
+        state = self.init_hidden(batch_size, lazy=self.lazy_expand)
         outputs = []
         #----------------noun------------
         outputs3 = []
         sample_seq = []
         sample_logprobs = []
-        state3 = self.init_hidden(batch_size)
+        state3 = self.init_hidden(batch_size, lazy=self.lazy_expand)
         #--------------self-adaption-------
         outputs2 = []
-        state2 = self.init_hidden(batch_size)
+        state2 = self.init_hidden(batch_size, lazy=self.lazy_expand)
         #-----------------verb-------------
         outputs4 = []
-        state4 = self.init_hidden(batch_size)
+        state4 = self.init_hidden(batch_size, lazy=self.lazy_expand)
         #----------------------------------
         # -- if <image feature> is input at the first step, use index -1
         # -- the <eos> token is not used for training
         start_i = -1 if self.model_type == 'standard' else 0
         end_i = seq.size(1) - 1
         #-------length-----------
-        length = (seq != 0).sum(dim=-1).to(torch.long)
-        length_1 = (length <= 6).to(torch.long)
-        length_2 = ((length >= 7) & (length <= 12)).to(torch.long)
-        length_3 = ((length >= 13) & (length <= 22)).to(torch.long)
-        length = length_1 * 1 + length_2 * 2 + length_3 * 3
+        if length is None:
+            length = self.length_control(seq)
         #---------ada-------------
-        ada = torch.LongTensor(length.shape[0]).fill_(0).cuda()
+        ada = torch.LongTensor(length.shape[0]).fill_(0).to(seq.device)
+
+        controls = [length, ada, noun, verb]
+        if streams is not None:
+            # one control stream per caption, the streams[i]-th one for caption i
+            controls = [torch.stack(controls, 0).gather(0, streams.view(1, -1)).view(-1)]
+
+        if self.model_type == 'concat' and not (self.training and (self.ss_prob > 0 or self.mixer_from > 0)):
+            # every input word is known: run all the streams over whole packed sequences
+            return self.forward_packed(fc_feats, seq, controls, return_hidden=return_hidden)
+        if (self.fuse_streams or streams is not None) and self.model_type != 'standard':
+            # the loop below runs all the streams, forward_fused only the selected one
+            return self.forward_fused(fc_feats, video_gates, seq, controls, return_hidden=return_hidden)
+        assert not return_hidden and streams is None, 'return_hidden needs fuse_streams, and both it and streams a concat or manet model'
 
         for token_idx in range(start_i, end_i):
             if token_idx == -1:
@@ -385,25 +523,7 @@ class CaptionModel(nn.Module):
                 # token_idx = 0 corresponding to the <BOS> token
                 # (already encoded in seq)
 
-                if self.training and token_idx >= 1 and self.ss_prob > 0.0:
-                    sample_prob = fc_feats.data.new(batch_size).uniform_(0, 1)
-                    sample_mask = sample_prob < self.ss_prob
-                    if sample_mask.sum() == 0:
-                        it = seq[:, token_idx].clone()
-                    else:
-                        sample_ind = sample_mask.nonzero().view(-1)
-                        it = seq[:, token_idx].data.clone()
-                        # fetch prev distribution: shape Nx(M+1)
-                        prob_prev = torch.exp(outputs[-1].data)
-                        sample_ind_tokens = torch.multinomial(prob_prev, 1).view(-1).index_select(0, sample_ind)
-                        it.index_copy_(0, sample_ind, sample_ind_tokens)
-                        it = Variable(it, requires_grad=False)
-                elif self.training and self.mixer_from > 0 and token_idx >= self.mixer_from:
-                    prob_prev = torch.exp(outputs[-1].data)
-                    it = torch.multinomial(prob_prev, 1).view(-1)
-                    it = Variable(it, requires_grad=False)
-                else:
-                    it = seq[:, token_idx].clone()
+                it = self.get_input(seq, token_idx, outputs[-1] if outputs else None)
 
                 if token_idx >= 1:
                     # store the seq and its logprobs
@@ -426,13 +546,13 @@ class CaptionModel(nn.Module):
             else:
                 if self.model_type == 'manet':
                     fc_feats = self.manet(fc_feats, state[0])
-                output, state = self.core(torch.cat([xt, fc_feats], 1), state)
+                output, state = self.core_step(xt, fc_feats, video_gates, state)
                 #------------ada---------
-                output2, state2 = self.core(torch.cat([xt2, fc_feats], 1), state2)
+                output2, state2 = self.core_step(xt2, fc_feats, video_gates, state2)
                 #------------noun---------
-                output3, state3 = self.core(torch.cat([xt3, fc_feats], 1), state3)
+                output3, state3 = self.core_step(xt3, fc_feats, video_gates, state3)
                 #------------verb---------
-                output4, state4 = self.core(torch.cat([xt4, fc_feats], 1), state4)
+                output4, state4 = self.core_step(xt4, fc_feats, video_gates, state4)
 
             # print(output)
 
@@ -461,6 +581,107 @@ class CaptionModel(nn.Module):
                torch.cat([_.unsqueeze(1) for _ in sample_seq], 1), \
                torch.cat([_.unsqueeze(1) for _ in sample_logprobs], 1) \
 
+    def forward_fused(self, fc_feats, video_gates, seq, controls, return_hidden=False):
+        """Same as the loop of forward, with the control streams stacked along the
+        batch, so that each step runs one embedding lookup, one core call and one
+        logit projection for all of them. Returns the log probabilities of every
+        stream, then the seq and logprobs fed to the first stream; with
+        return_hidden, only the S x B x L x H inputs of the logit layer of the
+        streams (see MultiStreamCriterion).
+        """
+        sampled_inputs = self.training and (self.ss_prob > 0 or self.mixer_from > 0)
+        if self.model_type == 'concat' and not sampled_inputs:
+            return self.forward_packed(fc_feats, seq, controls, return_hidden=return_hidden)
+
+        batch_size = seq.size(0)
+        num_streams = len(controls)
+        control = torch.cat(controls, 0)
+        fc_feats_streams = fc_feats.repeat(num_streams, 1)
+        video_gates_streams = video_gates.repeat(num_streams, 1) if video_gates is not None else None
+        state = self.init_hidden(num_streams * batch_size, lazy=self.lazy_expand)
+        outputs = []
+        sample_seq = []
+        sample_logprobs = []
+
+        for token_idx in range(0, seq.size(1) - 1):
+            # the first stream drives scheduled sampling, as in forward
+            logprobs_prev = outputs[-1][0] if outputs else None
+            if return_hidden and sampled_inputs and outputs:
+                logprobs_prev = F.log_softmax(self.logit(logprobs_prev))
+            it = self.get_input(seq, token_idx, logprobs_prev)
+
+            if token_idx >= 1 and not return_hidden:
+                # store the seq and its logprobs
+                sample_seq.append(it.data)
+                logprobs = outputs[-1][0].gather(1, it.unsqueeze(1))
+                sample_logprobs.append(logprobs.view(-1))
+
+            # break if all the sequences end, which requires EOS token = 0
+            if it.data.sum() == 0:
+                break
+            xt = self.embed(it).repeat(num_streams, 1) + self.control_embed(control)
+
+            if self.model_type == 'manet':
+                # the modal attention follows the first stream, as in forward
+                h = state[0] if self.rnn_type == 'lstm' else state
+                fc_feats = self.manet(fc_feats, h[:, :batch_size])
+                fc_feats_streams = fc_feats.repeat(num_streams, 1)
+            output, state = self.core_step(xt, fc_feats_streams, video_gates_streams, state)
+
+            output = self.dropout(output)
+            if not return_hidden:
+                output = F.log_softmax(self.logit(output))
+            outputs.append(output.view(num_streams, batch_size, -1))
+
+        # S x B x L x V (S x B x L x H with return_hidden)
+        outputs = torch.stack(outputs, 2)
+        if return_hidden:
+            return outputs
+        return tuple(outputs) + (torch.cat([_.unsqueeze(1) for _ in sample_seq], 1),
+                                 torch.cat([_.unsqueeze(1) for _ in sample_logprobs], 1))
+
+    def forward_packed(self, fc_feats, seq, controls, return_hidden=False):
+        """Teacher-forced forward_fused: every input word is known up front, so the
+        core runs once over the packed sequences of all the streams, skipping the
+        padding of each caption. The log probabilities past the end of a caption
+        (which the criteria mask) come from a zero hidden state instead of the
+        padded steps of the loop; all the others are the same.
+        """
+        batch_size = seq.size(0)
+        num_streams = len(controls)
+        control = torch.cat(controls, 0)
+
+        # steps run by the loop of forward_fused, which stops at the first all-zero column
+        lengths = (seq.data != 0).long().sum(1)
+        num_steps = min(int(lengths.max()), seq.size(1) - 1)
+        lengths = lengths.clamp(1, num_steps).repeat(num_streams)
+
+        xt = self.embed(seq[:, :num_steps]).repeat(num_streams, 1, 1) + \
+            self.control_embed(control.unsqueeze(1).repeat(1, num_steps))
+        # the video features are part of the input of every step, so the rows of a
+        # video are materialized for all its captions here even with lazy_expand
+        fc_feats = expand_rows(fc_feats.repeat(num_streams, 1), num_streams * batch_size)
+        xt = torch.cat([xt, fc_feats.unsqueeze(1).expand(-1, num_steps, -1)], 2)
+
+        # packing expects the sequences by decreasing length
+        sorted_lengths, order = lengths.sort(0, descending=True)
+        _, inverse = order.sort(0)
+        xt = pack_padded_sequence(xt.index_select(0, order).transpose(0, 1), sorted_lengths.tolist())
+        output, _ = self.core.forward_seq(xt, self.init_hidden(num_streams * batch_size))
+        output, _ = pad_packed_sequence(output, total_length=num_steps)
+        output = self.dropout(output.transpose(0, 1).index_select(0, inverse))
+        if return_hidden:
+            return output.view(num_streams, batch_size, num_steps, -1)
+
+        # S x B x L x V
+        outputs = F.log_softmax(self.logit(output), dim=-1)
+        outputs = outputs.view(num_streams, batch_size, num_steps, -1)
+
+        # words fed from step 1 on (with the all-zero column the loop breaks at) and their logprobs
+        sample_seq = seq.data[:, 1:min(num_steps + 1, seq.size(1) - 1)]
+        sample_logprobs = outputs[0][:, :sample_seq.size(1)].gather(2, sample_seq.unsqueeze(2)).squeeze(2)
+        return tuple(outputs) + (sample_seq, sample_logprobs)
+
     def sample(self, feats, opt={}):
         sample_max = opt.get('sample_max', 1)
         beam_size = opt.get('beam_size', 1)
@@ -468,15 +689,31 @@ class CaptionModel(nn.Module):
         expand_feat = opt.get('expand_feat', 0)
         #----修改-----
         control_id = opt.get('control_id',0)
+        # with several control ids, the videos are decoded once per id, the captions
+        # of the i-th id in the i-th block of batch_size rows of the output
+        control_ids = opt.get('control_ids', [control_id])
+        # look for the end of all the captions only every check_every steps (0: never)
+        # rather than syncing with the device at every step; the output is then cut
+        # back to the steps a check at every step would have run
+        check_every = opt.get('check_every', 1)
 
         if beam_size > 1:
             return self.sample_beam(feats, opt)
 
         fc_feats = self.feat_pool(feats)
+        if len(control_ids) > 1:
+            fc_feats = fc_feats.repeat(len(control_ids), 1)
+        video_gates = self.core.video_gates(fc_feats) if self.core.factorized else None
         if expand_feat == 1:
             fc_feats = self.feat_expander(fc_feats)
+            video_gates = self.feat_expander(video_gates) if video_gates is not None else None
         batch_size = fc_feats.size(0)
         state = self.init_hidden(batch_size)
+        control = None
+        if 'control_id' in opt or 'control_ids' in opt:
+            # the control embedding of each row, as in sample_beam
+            control = fc_feats.data.new(control_ids).long().view(-1, 1).expand(len(control_ids), batch_size // len(control_ids))
+            control = control.contiguous().view(-1)
 
         seq = []
         seqLogprobs = []
@@ -500,18 +737,21 @@ class CaptionModel(nn.Module):
                 else:
                     if temperature == 1.0:
                         # fetch prev distribution: shape Nx(M+1)
-                        prob_prev = torch.exp(logprobs.data).cpu()
+                        prob_prev = torch.exp(logprobs.data)
                     else:
                         # scale logprobs by temperature
-                        prob_prev = torch.exp(torch.div(logprobs.data, temperature)).cpu()
+                        prob_prev = torch.exp(torch.div(logprobs.data, temperature))
                     # import pdb; pdb.set_trace()
-                    it = torch.multinomial(prob_prev, 1).cuda()
+                    # sampled on the device of the model
+                    it = torch.multinomial(prob_prev, 1)
                     # gather the logprobs at sampled adaitions
                     sampleLogprobs = logprobs.gather(1, Variable(it, requires_grad=False))
                     # and flatten indices for downstream processing
                     it = it.view(-1).long()
 
                 xt = self.embed(Variable(it, requires_grad=False))
+                if control is not None:
+                    xt = xt + self.control_embed(control)
 
             if token_idx >= 1:
                 unfinished = unfinished * (it > 0)
@@ -522,7 +762,7 @@ class CaptionModel(nn.Module):
                 seqLogprobs.append(sampleLogprobs.view(-1))
 
                 # requires EOS token = 0
-                if unfinished.sum() == 0:
+                if check_every > 0 and token_idx % check_every == 0 and unfinished.sum() == 0:
                     break
 
             if self.model_type == 'standard':
@@ -530,143 +770,209 @@ class CaptionModel(nn.Module):
             else:
                 if self.model_type == 'manet':
                     fc_feats = self.manet(fc_feats, state[0])
-                output, state = self.core(torch.cat([xt, fc_feats], 1), state)
+                output, state = self.core_step(xt, fc_feats, video_gates, state)
 
             logprobs = F.log_softmax(self.logit(output))
 
-        return torch.cat([_.unsqueeze(1) for _ in seq], 1), torch.cat([_.unsqueeze(1) for _ in seqLogprobs], 1)
+        seq = torch.cat([_.unsqueeze(1) for _ in seq], 1)
+        seqLogprobs = torch.cat([_.unsqueeze(1) for _ in seqLogprobs], 1)
+        if check_every != 1:
+            # the first step at which all the captions had ended
+            ended = ((seq != 0).sum(0) == 0).nonzero()
+            if len(ended) > 0:
+                seq = seq[:, :int(ended[0]) + 1]
+                seqLogprobs = seqLogprobs[:, :int(ended[0]) + 1]
+        return seq, seqLogprobs
 
     def sample_beam(self, feats, opt={}):
         """
-        modified from https://github.com/ruotianluo/self-critical.pytorch
+        Beam search over the beam_size beams of all the videos (and control ids, see
+        sample) at once, following
+        https://github.com/ruotianluo/self-critical.pytorch: the beams keep expanding
+        after <eos>, every selected continuation that is <eos> (or reaches the last
+        step) makes a finished caption, and the finished caption of the lowest
+        perplexity is returned for each video.
         """
         beam_size = opt.get('beam_size', 5)
+        # control_id
+        control_id = opt.get('control_id', 0)
+        control_ids = opt.get('control_ids', [control_id])
+
         fc_feats = self.feat_pool(feats)
+        video_gates = self.core.video_gates(fc_feats) if self.core.factorized else None
+        if len(control_ids) > 1:
+            # the features are pooled once, then searched once per control id
+            fc_feats = fc_feats.repeat(len(control_ids), 1)
+            video_gates = video_gates.repeat(len(control_ids), 1) if video_gates is not None else None
         batch_size = fc_feats.size(0)
-        # control_id
-        control_id = opt.get('control_id',0)
+        num_rows = batch_size * beam_size
+
+        # the beams of video k are the rows k * beam_size ... (k + 1) * beam_size - 1
+        fc_feats = expand_rows(fc_feats, num_rows)
+        state = self.init_hidden(num_rows)
+        control = fc_feats.data.new(control_ids).long().view(-1, 1).expand(len(control_ids), num_rows // len(control_ids))
+        control = control.contiguous().view(-1)
+        first_beam = torch.arange(0, num_rows, beam_size, dtype=torch.long, device=fc_feats.device)
+
+        beam_seq = fc_feats.data.new(num_rows, self.seq_length).long().zero_()
+        beam_seq_logprobs = fc_feats.data.new(num_rows, self.seq_length).zero_()
+        # running sum of logprobs for each beam
+        beam_logprobs_sum = fc_feats.data.new(batch_size, beam_size).zero_()
 
-        seq = torch.LongTensor(self.seq_length, batch_size).zero_()
-        seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
-
-        # 新增加
-        control_id = seq.new_full((beam_size,), control_id).cuda()
-
-        self.done_beams = [[] for _ in range(batch_size)]
-        for k in range(batch_size):
-            state = self.init_hidden(beam_size)
-            fc_feats_k = fc_feats[k].expand(
-                beam_size, self.video_encoding_size)
-
-            beam_seq = torch.LongTensor(self.seq_length, beam_size).zero_()
-            beam_seq_logprobs = torch.FloatTensor(self.seq_length, beam_size).zero_()
-            # running sum of logprobs for each beam
-            beam_logprobs_sum = torch.zeros(beam_size)
-
-            # -- if <image feature> is input at the first step, use index -1
-            start_i = -1 if self.model_type == 'standard' else 0
-            end_i = self.seq_length - 1
-
-            for token_idx in range(start_i, end_i):
-                if token_idx == -1:
-                    xt = fc_feats_k
-                elif token_idx == 0:  # input <bos>
-                    it = fc_feats.data.new(beam_size).long().fill_(self.bos_index)
-                    #xt = self.embed(Variable(it, requires_grad=False))
-                    #----混合----
-                    xt = self.embed(Variable(it, requires_grad=False)) + self.control_embed(control_id)
+        # finished caption of the lowest perplexity so far
+        seq = fc_feats.data.new(batch_size, self.seq_length).long().zero_()
+        seqLogprobs = fc_feats.data.new(batch_size, self.seq_length).zero_()
+        best_ppl = fc_feats.data.new(batch_size).fill_(float('inf'))
+
+        # -- if <image feature> is input at the first step, use index -1
+        start_i = -1 if self.model_type == 'standard' else 0
+        end_i = self.seq_length - 1
 
+        for token_idx in range(start_i, end_i):
+            if token_idx == -1:
+                xt = fc_feats
+            else:
+                if token_idx == 0:  # input <bos>
+                    it = fc_feats.data.new(num_rows).long().fill_(self.bos_index)
                 else:
-                    """perform a beam merge. that is,
-                    for every previous beam we now many new adasibilities to branch out
-                    we need to resort our beams to maintain the loop invariant of keeping
-                    the top beam_size most likely sequences."""
-                    logprobsf = logprobs.float()  # lets go to CPU for more efficiency in indexing operations
-                    # sorted array of logprobs along each previous beam (last
-                    # true = descending)
-                    ys, ix = torch.sort(logprobsf, 1, True)
-                    candidates = []
-                    cols = min(beam_size, ys.size(1))
-                    rows = beam_size
-                    if token_idx == 1:  # at first time step only the first beam is active
-                        rows = 1
-                    for c in range(cols):
-                        for q in range(rows):
-                            # compute logprob of expanding beam q with word in
-                            # (sorted) adaition c
-                            local_logprob = ys[q, c]
-                            candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                            
-                            if float(torch.__version__[:3]) > 0.5:
-                                candidates.append({'c': ix.data[q, c], 'q': q, 'p': candidate_logprob.data.item()
-                                    , 'r': local_logprob.item()})
-                            else:
-                                candidates.append({'c': ix.data[q, c], 'q': q, 'p': candidate_logprob.data[
-                                    0], 'r': local_logprob.data[0]})
-                    candidates = sorted(candidates, key=lambda x: -x['p'])
-
-                    # construct new beams
-                    new_state = [_.clone() for _ in state]
+                    logprobsf = logprobs.data.float()
+                    vocab_size = logprobsf.size(1)
+                    if token_idx == 1:
+                        # at first time step only the first beam is active
+                        scores = logprobsf.view(batch_size, beam_size, vocab_size)[:, 0]
+                    else:
+                        scores = (beam_logprobs_sum.unsqueeze(2) + logprobsf.view(batch_size, beam_size, vocab_size)).view(batch_size, -1)
+                    # the best beam_size continuations of all the beams of each video
+                    beam_logprobs_sum, ix = scores.topk(beam_size, 1)
+                    # // floors on any torch version, where / divides exactly from 1.5 on
+                    rows = (first_beam.unsqueeze(1) + ix // vocab_size).view(-1)
+                    it = (ix % vocab_size).view(-1)
+
+                    # fork the beams: histories and recurrent states follow their rows
+                    beam_seq = beam_seq.index_select(0, rows)
+                    beam_seq_logprobs = beam_seq_logprobs.index_select(0, rows)
+                    if isinstance(state, tuple):
+                        state = tuple(_.index_select(1, rows) for _ in state)
+                    else:
+                        state = state.index_select(1, rows)
+
+                    beam_seq[:, token_idx - 1] = it
+                    # the raw logprob here
+                    beam_seq_logprobs[:, token_idx - 1] = logprobsf.index_select(0, rows).gather(1, it.unsqueeze(1)).view(-1)
+
+                    # END token special case here, or we reached the end
+                    done = (it == 0).view(batch_size, beam_size)
+                    if token_idx == self.seq_length - 2:
+                        done.fill_(1)
                     if token_idx > 1:
-                        # well need these as reference when we fork beams
-                        # around
-                        beam_seq_prev = beam_seq[:token_idx - 1].clone()
-                        beam_seq_logprobs_prev = beam_seq_logprobs[:token_idx - 1].clone()
-
-                    for vix in range(beam_size):
-                        v = candidates[vix]
-                        # fork beam index q into index vix
-                        if token_idx > 1:
-                            beam_seq[
-                            :token_idx - 1,
-                            vix] = beam_seq_prev[:, v['q']]
-                            beam_seq_logprobs[:token_idx - 1, vix] = beam_seq_logprobs_prev[:, v['q']]
-
-                        # rearrange recurrent states
-                        for state_ix in range(len(new_state)):
-                            # copy over state in previous beam q to new beam at
-                            # vix
-                            new_state[state_ix][0, vix] = state[state_ix][0, v['q']]  # dimension one is time step
-
-                        # append new end terminal at the end of this beam
-                        # c'th word is the continuation
-                        beam_seq[token_idx - 1, vix] = v['c']
-                        beam_seq_logprobs[token_idx - 1, vix] = v['r']  # the raw logprob here
-                        # the new (sum) logprob along this beam
-                        beam_logprobs_sum[vix] = v['p']
-
-                        if v['c'] == 0 or token_idx == self.seq_length - 2:
-                            # END token special case here, or we reached the end.
-                            # add the beam to a set of done beams
-                            if token_idx > 1:
-                                ppl = np.exp(-beam_logprobs_sum[vix] / (token_idx - 1))
-                            else:
-                                ppl = 10000
-                            self.done_beams[k].append({'seq': beam_seq[:, vix].clone(), 'logps': beam_seq_logprobs[:, vix].clone(), 'p': beam_logprobs_sum[vix], 'ppl': ppl})
-
-                    # encode as vectors
-                    it = beam_seq[token_idx - 1]
-                    #xt = self.embed(Variable(it.cuda()))
-                    xt = self.embed(Variable(it.cuda())) + self.control_embed(control_id)
+                        ppl = torch.exp(-beam_logprobs_sum / (token_idx - 1))
+                    else:
+                        ppl = beam_logprobs_sum.new(batch_size, beam_size).fill_(10000)
+                    step_ppl, step_beam = ppl.masked_fill(done == 0, float('inf')).min(1)
 
-                if token_idx >= 1:
-                    state = new_state
+                    # earlier captions win ties, as in a stable sort of all the finished ones
+                    better = step_ppl < best_ppl
+                    best_ppl = torch.where(better, step_ppl, best_ppl)
+                    better = better.unsqueeze(1).expand_as(seq)
+                    seq = torch.where(better, beam_seq.index_select(0, first_beam + step_beam), seq)
+                    seqLogprobs = torch.where(better, beam_seq_logprobs.index_select(0, first_beam + step_beam), seqLogprobs)
 
-                if self.model_type == 'standard':
-                    output, state = self.core(xt, state)
-                else:
-                    if self.model_type == 'manet':
-                        fc_feats_k = self.manet(fc_feats_k, state[0])
-                    output, state = self.core(torch.cat([xt, fc_feats_k], 1), state)
+                xt = self.embed(Variable(it, requires_grad=False)) + self.control_embed(control)
 
-                logprobs = F.log_softmax(self.logit(output))
+            if self.model_type == 'standard':
+                output, state = self.core(xt, state)
+            else:
+                if self.model_type == 'manet':
+                    fc_feats = self.manet(fc_feats, state[0])
+                output, state = self.core_step(xt, fc_feats, video_gates, state)
+
+            logprobs = F.log_softmax(self.logit(output))
+
+        return seq.cpu(), seqLogprobs.cpu()
 
-            # self.done_beams[k] = sorted(self.done_beams[k], key=lambda x: -x['p'])
-            self.done_beams[k] = sorted(self.done_beams[k], key=lambda x: x['ppl'])
 
-            # the first beam has highest cumulative score
-            seq[:, k] = self.done_beams[k][0]['seq']
-            seqLogprobs[:, k] = self.done_beams[k][0]['logps']
+class CaptionDecoder(nn.Module):
+    """
+    Inference view of a concat/manet CaptionModel (sharing its modules) with a
+    stateful step API, to be traced by export_decoder:
+        fc_feats = encode(feats)                # feats: tuple of feature tensors
+        state = init_state(fc_feats)
+        logprobs, state = step(tokens, control_ids, state, fc_feats)
+    the first tokens being <bos>. The state is one tensor: (h, c) stacked as
+    2 x num_layers x N x rnn_size for an LSTM core, 1 x num_layers x N x rnn_size
+    otherwise.
+    """
+
+    def __init__(self, model):
+        super(CaptionDecoder, self).__init__()
+        assert model.model_type in ['concat', 'manet'], 'cannot export a %s model' % model.model_type
+        self.model_type = model.model_type
+        self.rnn_type = model.rnn_type
+        self.num_layers = model.num_layers
+        self.rnn_size = model.rnn_size
+
+        self.feat_pool = model.feat_pool
+        self.embed = model.embed
+        self.control_embed = model.control_embed
+        self.core = model.core
+        self.logit = model.logit
+        if self.model_type == 'manet':
+            self.manet = model.manet
 
-        return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+    def encode(self, feats):
+        return self.feat_pool(list(feats))
+
+    def init_state(self, fc_feats):
+        num_states = 2 if self.rnn_type == 'lstm' else 1
+        return fc_feats.new_zeros(num_states, self.num_layers, fc_feats.size(0), self.rnn_size)
+
+    def step(self, tokens, control_ids, state, fc_feats):
+        state = (state[0], state[1]) if self.rnn_type == 'lstm' else state[0]
+        xt = self.embed(tokens) + self.control_embed(control_ids)
+        if self.model_type == 'manet':
+            fc_feats = self.manet(fc_feats, state[0])
+        output, state = self.core(torch.cat([xt, fc_feats], 1), state)
+        logprobs = F.log_softmax(self.logit(output), dim=1)
+        return logprobs, torch.stack(state) if self.rnn_type == 'lstm' else state.unsqueeze(0)
+
+
+def quantize_dynamic(model):
+    """Copy of a CaptionModel for CPU inference, with dynamic int8 weights in the
+    logit layer, the FeatPool linear layers and the RNN core (needs torch >= 1.3).
+    A quantized core has no float weights to step by hand, so the copy runs the
+    core itself rather than the factorized step. `model` is left as it is.
+    """
+    assert hasattr(torch, 'quantization'), 'dynamic quantization needs torch >= 1.3'
+    modules = set(['logit'] + ['feat_pool.feat_list.%d.0' % i for i in range(len(model.feat_pool.feat_list))])
+    quantized_rnn = getattr(torch.nn.quantized.dynamic, model.rnn_type.upper(), None)
+    if quantized_rnn is not None:
+        modules.add('core.rnn')
+    qmodel = torch.quantization.quantize_dynamic(copy.deepcopy(model).cpu().eval(), modules, dtype=torch.qint8, inplace=True)
+    if quantized_rnn is not None:
+        # the core has no bias, which some versions skip silently
+        assert isinstance(qmodel.core.rnn, quantized_rnn), 'the RNN core was not quantized: %s' % type(qmodel.core.rnn)
+        qmodel.core.factorized = False
+    return qmodel
+
+
+def export_decoder(model, feats, export_file, meta=None):
+    """Trace the CaptionDecoder of `model` on the example batch `feats` and save
+    it as a TorchScript file, loaded with torch.jit.load alone (needs torch >= 1.2).
+    The feature shapes other than the batch size are fixed by the trace. `meta`
+    (e.g. the vocabulary) is stored with the bos index and the maximum caption
+    length in the extra file meta.json.
+    """
+    assert hasattr(torch.jit, 'trace_module'), 'exporting the decoder needs torch >= 1.2'
+    decoder = CaptionDecoder(model).eval()
+    with torch.no_grad():
+        feats = tuple(feats)
+        fc_feats = decoder.encode(feats)
+        state = decoder.init_state(fc_feats)
+        tokens = fc_feats.new_full((fc_feats.size(0),), model.bos_index).long()
+        control_ids = torch.zeros_like(tokens)
+        traced = torch.jit.trace_module(decoder, {'encode': (feats,),
+                                                  'init_state': (fc_feats,),
+                                                  'step': (tokens, control_ids, state, fc_feats)})
+
+    meta = dict(meta or {}, bos_index=model.bos_index, seq_length=model.seq_length)
+    torch.jit.save(traced, export_file, _extra_files={'meta.json': json.dumps(meta)})
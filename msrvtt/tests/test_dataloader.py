@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+"""Tests of the length-bucketed batch order of the DataLoader (--bucket_batches)"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+dataloader = pytest.importorskip('dataloader')
+
+
+def make_loader(bucket_batches, num_videos=256, batch_size=8, seq_per_img=20, seq_length=30, seed=0):
+    """DataLoader over synthetic captions only: every video has seq_per_img captions,
+    the longest of which is max_length[video] words long
+    """
+    rng = np.random.RandomState(seed)
+    max_length = rng.randint(4, seq_length - 1, size=num_videos)
+    caption_length = rng.randint(2, max_length[:, np.newaxis] + 1, size=(num_videos, seq_per_img))
+    caption_length[np.arange(num_videos), rng.randint(seq_per_img, size=num_videos)] = max_length
+    caption_length = caption_length.reshape(-1)
+
+    labels = np.zeros((len(caption_length), seq_length), dtype=np.uint16)
+    for row, length in enumerate(caption_length):
+        labels[row, :length] = rng.randint(2, 100, size=length)
+
+    loader = dataloader.DataLoader.__new__(dataloader.DataLoader)
+    loader.pid = os.getpid()
+    loader.mode = 'val'
+    loader.iterator = 0
+    loader.epoch = 0
+    loader.batch_size = batch_size
+    loader.seq_per_img = seq_per_img
+    loader.seq_length = seq_length
+    loader.bucket_batches = bucket_batches
+    loader.bcmrscores_pkl = None
+    loader.use_resnet_feature = 0
+    loader.use_c3d_feature = 0
+    loader.use_audio_feature = 0
+    loader.use_global_local_feature = 0
+    loader.num_videos = num_videos
+    loader.videos = list(range(num_videos))
+    loader.index = list(range(num_videos))
+    loader.has_label = True
+    loader.labels = labels
+    loader.label_start_ix = np.arange(num_videos, dtype=np.int32) * seq_per_img
+    loader.label_end_ix = loader.label_start_ix + seq_per_img
+    loader.video_length = loader.get_video_lengths()
+    return loader, max_length
+
+
+def epoch_widths(loader, seed=0):
+    """Label width of every batch of one shuffled epoch"""
+    np.random.seed(seed)
+    loader.shuffle_videos()
+    widths = []
+    seen = []
+    for _ in range(loader.get_num_videos() // loader.get_batch_size()):
+        idxs = loader.next_batch_idxs()
+        seen.extend(idxs)
+        widths.append(loader.load_batch(idxs)['labels'].size(1))
+    assert sorted(seen) == list(range(loader.get_num_videos()))
+    return np.array(widths)
+
+
+def test_video_lengths_are_the_longest_captions():
+    loader, max_length = make_loader(bucket_batches=4)
+    assert np.array_equal(loader.get_video_lengths(), max_length)
+
+
+def test_bucketing_shrinks_the_trimmed_width():
+    # one batch per bucket only sorts the videos within their batches: the batches
+    # are those of the plain shuffle, trimmed to their longest caption
+    unbucketed, _ = make_loader(bucket_batches=1)
+    bucketed, _ = make_loader(bucket_batches=16)
+
+    unbucketed_widths = epoch_widths(unbucketed)
+    bucketed_widths = epoch_widths(bucketed)
+
+    assert (bucketed_widths <= bucketed.get_seq_length()).all()
+    assert bucketed_widths.mean() < 0.8 * unbucketed_widths.mean()
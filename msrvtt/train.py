@@ -7,6 +7,7 @@ import json
 import uuid
 import logging
 import numpy as np
+from collections import deque
 
 import argparse
 import torch
@@ -18,8 +19,8 @@ from torch.nn.utils import clip_grad_norm
 from datetime import datetime
 from six.moves import cPickle
 
-from dataloader import DataLoader
-from model import CaptionModel, CrossEntropyCriterion, RewardCriterion, CrossEntropyCriterion2, CrossEntropyCriterion3, CrossEntropyCriterion4
+from dataloader import DataLoader, BatchPrefetcher, WorkerBatchLoader
+from model import CaptionModel, CrossEntropyCriterion, RewardCriterion, MultiStreamCriterion
 
 import utils
 import opts
@@ -35,6 +36,9 @@ from pycocoevalcap.rouge.rouge import Rouge
 
 logger = logging.getLogger(__name__)
 
+# names of the control ids decoded at test time, in the reports
+CONTROL_NAMES = {1: 'short', 2: 'middle', 3: 'long', 4: 'single-object', 5: 'multi-object', 6: 'single-action', 7: 'multi-action'}
+
 
 def check_model(model, opt, infos, infos_history):
     if opt.eval_metric == 'MSRVTT':
@@ -63,11 +67,14 @@ def check_model(model, opt, infos, infos_history):
     logger.info('Updated history to: %s', opt.history_file)
 
 #------------修改----------
-def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2, criterion3, criterion4, rl_criterion=None ):
+def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criterion=None, fused_criterion=None, worker_pool=None):
     infos = {'iter': 0, 'epoch': 0, 'start_epoch': 0, 'best_score': float('-inf'), 'best_iter': 0, 'best_epoch': opt.max_epochs}
 
     checkpoint_checked = False
     rl_training = False
+    # pipelined RL (--reward_workers): the rollouts whose rewards are being computed
+    reward_pool = None
+    rollouts = deque()
     seq_per_img = train_loader.get_seq_per_img()
     infos_history = {}
 
@@ -75,7 +82,7 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
         # loading the same model file at a different experiment dir
         start_from_file = os.path.join(opt.start_from, os.path.basename(opt.model_file)) if os.path.isdir(opt.start_from) else opt.start_from
         logger.info('Loading state from: %s', start_from_file)
-        checkpoint = torch.load(start_from_file)
+        checkpoint = torch.load(start_from_file, map_location=opt.device)
         model.load_state_dict(checkpoint['model'])
         infos = checkpoint['infos']
         infos['start_epoch'] = infos['epoch']
@@ -99,13 +106,12 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
         noun = Variable(data['noun'], volatile=False)
         verb = Variable(data['verb'], volatile=False)
 
-        if torch.cuda.is_available():
-            feats = [feat.cuda() for feat in feats]
-            labels = labels.cuda()
-            masks = masks.cuda()
-            #-----noun--
-            noun = noun.cuda()
-            verb = verb.cuda()
+        feats = [feat.to(opt.device) for feat in feats]
+        labels = labels.to(opt.device)
+        masks = masks.to(opt.device)
+        #-----noun--
+        noun = noun.to(opt.device)
+        verb = verb.to(opt.device)
 
         # implement scheduled sampling
         opt.ss_prob = 0
@@ -117,7 +123,13 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
         if opt.use_rl == 1 and infos['epoch'] >= opt.use_rl_after and not rl_training:
             logger.info('Using RL objective...')
             rl_training = True
-            bcmr_scorer = {'Bleu_4': Bleu(), 'CIDEr': CiderD(df=opt.train_cached_tokens), 'METEOR': Meteor(), 'ROUGE_L': Rouge()}[opt.eval_metric]
+            scorer_args = (opt.eval_metric, opt.train_cached_tokens, opt.vocab_size, opt.use_eos, opt.fast_cider)
+            if worker_pool is not None:
+                logger.info('Computing the rewards in %d worker processes, with a staleness of %d steps', opt.reward_workers, opt.reward_staleness)
+                reward_pool = worker_pool
+                reward_pool.set_scorer(*scorer_args)
+            else:
+                bcmr_scorer = utils.get_reward_scorer(*scorer_args)
 
         mixer_from = opt.mixer_from
         if opt.use_mixer == 1 and rl_training:
@@ -137,13 +149,66 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
         optimizer.zero_grad()
         model.set_seq_per_img(seq_per_img)
 
-        if rl_training or opt.use_dxe:
+        if reward_pool is not None:
+            # roll out this batch without gradients and score it in the reward workers,
+            # then learn from the rollout of opt.reward_staleness steps ago, with its
+            # log probabilities recomputed by the current model
+            # the samples are those of the first control stream (length), conditioned
+            # on the length of the ground-truth captions
+            length = model.length_control(labels)
+            streams = labels.new_zeros(labels.size(0)) if model.model_type != 'standard' else None
+            with torch.no_grad():
+                model_res = model(feats, labels, noun, verb, streams=streams, length=length)[-2]
+                # the caption ends at its first <eos>
+                model_res = model_res * ((model_res == 0).long().cumsum(1) == 0).long()
+                if opt.use_it == 0:
+                    scst_baseline, _ = model.sample(feats, {'sample_max': 1, 'expand_feat': opt.expand_feat, 'check_every': opt.sample_check_every})
+
+            if opt.use_it == 1:
+                reward_pool.submit(utils.get_discrepant_reward, model_res.cpu(), data['gts'],
+                                   bcmrscores=data['bcmrscores'],
+                                   expand_feat=opt.expand_feat,
+                                   seq_per_img=train_loader.get_seq_per_img(),
+                                   dr_baseline_captions=dr_baseline_captions,
+                                   dr_baseline_type=opt.dr_baseline_type,
+                                   use_eos=opt.use_eos,
+                                   use_mixer=opt.use_mixer,
+                                   video_ids=data['ids'])
+            else:
+                reward_pool.submit(utils.get_self_critical_reward, model_res.cpu(), scst_baseline.cpu(), data['gts'],
+                                   expand_feat=opt.expand_feat,
+                                   seq_per_img=train_loader.get_seq_per_img(),
+                                   use_eos=opt.use_eos,
+                                   video_ids=data['ids'])
+            rollouts.append((feats, length, noun, verb, streams, model_res))
+
+            loss = None
+            if len(rollouts) > opt.reward_staleness:
+                feats_r, length_r, noun_r, verb_r, streams_r, model_res = rollouts.popleft()
+                reward, m_score, g_score = reward_pool.get()
+
+                # teacher-forced on <bos>, the rollout and a final <eos>
+                num_rows = model_res.size(0)
+                seq = torch.cat([model_res.new_full((num_rows, 1), model.bos_index), model_res, model_res.new_zeros(num_rows, 1)], 1)
+                ss_prob, mixer_from_ = model.ss_prob, model.mixer_from
+                model.set_ss_prob(0)
+                model.set_mixer_from(0)
+                # with the controls the rollout was sampled with, not those of seq
+                model_res, logprobs = model(feats_r, seq, noun_r, verb_r, streams=streams_r, length=length_r)[-2:]
+                model.set_ss_prob(ss_prob)
+                model.set_mixer_from(mixer_from_)
+
+                # the teacher-forced pass may stop earlier than the rollout did
+                reward = reward[:, :logprobs.size(1)]
+                loss = rl_criterion(model_res, logprobs, torch.from_numpy(reward).float().to(opt.device))
+
+        elif rl_training or opt.use_dxe:
             # using mixer
-            pred, model_res, logprobs = model(feats, labels)
+            model_res, logprobs = model(feats, labels, noun, verb)[-2:]
 
             if opt.use_it == 0:
                 # scst baseline in SCST paper
-                scst_baseline, _ = model.sample([Variable(f.data, volatile=True) for f in feats], {'sample_max': 1, 'expand_feat': opt.expand_feat})
+                scst_baseline, _ = model.sample([Variable(f.data, volatile=True) for f in feats], {'sample_max': 1, 'expand_feat': opt.expand_feat, 'check_every': opt.sample_check_every})
 
             if opt.use_it == 1:
                 bcmrscores = data['bcmrscores']
@@ -160,16 +225,18 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
                                                                 dr_baseline_captions=dr_baseline_captions,
                                                                 dr_baseline_type=opt.dr_baseline_type,
                                                                 use_eos=opt.use_eos,
-                                                                use_mixer=opt.use_mixer
+                                                                use_mixer=opt.use_mixer,
+                                                                video_ids=data['ids']
                                                                 )
             else:
                 # use scst baseline by default, compute self-critical reward
                 reward, m_score, g_score = utils.get_self_critical_reward(model_res, scst_baseline, data['gts'], bcmr_scorer,
                                                                           expand_feat=opt.expand_feat,
                                                                           seq_per_img=train_loader.get_seq_per_img(),
-                                                                          use_eos=opt.use_eos)
+                                                                          use_eos=opt.use_eos,
+                                                                          video_ids=data['ids'])
 
-            loss = rl_criterion(model_res, logprobs, Variable(torch.from_numpy(reward).float().cuda(), requires_grad=False))
+            loss = rl_criterion(model_res, logprobs, Variable(torch.from_numpy(reward).float().to(opt.device), requires_grad=False))
 
         else:
             # use cross-entropy (XE)
@@ -179,26 +246,41 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
             lambda2 = opt.lamba2
             lambda3 = opt.lamba3
             lambda4 = opt.lamba4
-            pred, pred2, pred3,pred4, _, _ = model(feats, labels, noun,verb)
-            #loss = criterion(pred, labels[:, 1:], masks[:, 1:])
-            #-------noun-------
-            loss = lambda1 * criterion(pred, labels[:, 1:], masks[:, 1:]) \
-                   + lambda2 * criterion2(pred2, labels[:, 1:], masks[:, 1:]) \
-                   + lambda3 * criterion3(pred3, labels[:, 1:], masks[:, 1:]) \
-                   + lambda4 * criterion4(pred4, labels[:, 1:], masks[:, 1:])
-
-
-        loss.backward()
-        clip_grad_norm(model.parameters(), opt.grad_clip)
-        optimizer.step()
-        if float(torch.__version__[:3]) > 0.5:
-            infos['TrainLoss'] = loss.item()
-        else:
-            infos['TrainLoss'] = loss.data[0]
+            if fused_criterion is not None:
+                # the streams are in the order length, ada, noun, verb
+                lambdas = [lambda1, lambda2, lambda3, lambda4]
+                if opt.stream_probs:
+                    # one stream per caption, unbiased for the loss of all the streams
+                    stream_probs = masks.new_tensor(opt.stream_probs)
+                    streams = torch.multinomial(stream_probs, labels.size(0), replacement=True)
+                    hidden = model(feats, labels, noun, verb, return_hidden=True, streams=streams)
+                    lambdas = (masks.new_tensor(lambdas) / stream_probs)[streams].view(1, -1)
+                else:
+                    hidden = model(feats, labels, noun, verb, return_hidden=True)
+                loss = fused_criterion(hidden, model.logit, labels[:, 1:], masks[:, 1:], lambdas)
+            else:
+                pred, pred2, pred3,pred4, _, _ = model(feats, labels, noun,verb)
+                #loss = criterion(pred, labels[:, 1:], masks[:, 1:])
+                #-------noun-------
+                loss = lambda1 * criterion(pred, labels[:, 1:], masks[:, 1:]) \
+                       + lambda2 * criterion(pred2, labels[:, 1:], masks[:, 1:]) \
+                       + lambda3 * criterion(pred3, labels[:, 1:], masks[:, 1:]) \
+                       + lambda4 * criterion(pred4, labels[:, 1:], masks[:, 1:])
+
+
+        # none while the first rollouts of pipelined RL are being scored
+        if loss is not None:
+            loss.backward()
+            clip_grad_norm(model.parameters(), opt.grad_clip)
+            optimizer.step()
+            if float(torch.__version__[:3]) > 0.5:
+                infos['TrainLoss'] = loss.item()
+            else:
+                infos['TrainLoss'] = loss.data[0]
         infos['mixer_from'] = mixer_from
         infos['dr_baseline_captions'] = dr_baseline_captions
 
-        if infos['iter'] % opt.print_log_interval == 0:
+        if infos['iter'] % opt.print_log_interval == 0 and loss is not None:
             elapsed_time = time.time() - t_start
             log_info = [('Epoch', infos['epoch']), ('Iter', infos['iter']), ('Loss', infos['TrainLoss'])]
             if rl_training or opt.use_dxe:
@@ -209,6 +291,14 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, criterion2
                 log_info += [('mixer_from', mixer_from)]
             if opt.use_it == 1 and rl_training:
                 log_info += [('dr_baseline_captions', dr_baseline_captions)]
+            if isinstance(train_loader, BatchPrefetcher):
+                # time the loop was starved of batches since the last log line
+                log_info += [('LoaderWait', train_loader.pop_wait_time())]
+            if reward_pool is not None:
+                # time spent scoring in the workers, and the part of it the loop waited for
+                score_time, wait_time = reward_pool.pop_times()
+                log_info += [('RewardTime', score_time), ('RewardWait', wait_time),
+                             ('RewardOverlap', 1 - wait_time / score_time if score_time > 0 else 0)]
             log_info += [('Time', elapsed_time)]
             logger.info('%s', '\t'.join(
                 ['{}: {}'.format(k, v) for (k, v) in log_info]))
@@ -247,7 +337,11 @@ def language_eval(predictions, cocofmt_file, opt):
     return lang_stats
 
 
-def validate(model, criterion, loader, opt):
+def validate(model, criterion, loader, opt, control_ids=None):
+    """Decode the videos of `loader` with opt.control_id, or once with each of
+    `control_ids` (from the same features, in one pass), in which case one
+    results dict per control id is returned.
+    """
     model.eval()
     loader.reset()
 
@@ -260,9 +354,11 @@ def validate(model, criterion, loader, opt):
 
     loss_sum = 0
     logger.info('#num_iters: %d, batch_size: %d, seg_per_image: %d', num_iters, batch_size, seq_per_img)
-    predictions = []
+    decode_control_ids = control_ids or [opt.control_id]
+    predictions = [[] for _ in decode_control_ids]
     gt_avglogps = []
-    test_avglogps = []
+    test_avglogps = [[] for _ in decode_control_ids]
+    decode_time = 0
     
     for ii in range(num_iters):
         data = loader.get_batch()
@@ -278,11 +374,10 @@ def validate(model, criterion, loader, opt):
                     masks = masks[:last_batch_size * seq_per_img]
 
 
-            if torch.cuda.is_available():
-                feats = [feat.cuda() for feat in feats]
-                if loader.has_label:
-                    labels = labels.cuda()
-                    masks = masks.cuda()
+            feats = [feat.to(opt.device) for feat in feats]
+            if loader.has_label:
+                labels = labels.to(opt.device)
+                masks = masks.to(opt.device)
 
             # if loader.has_label:
             #     t_start = time.time()
@@ -299,42 +394,56 @@ def validate(model, criterion, loader, opt):
                 #     loss_sum += loss.data[0]
             # 做修改
             t_start = time.time()#---修改
-            seq, logseq = model.sample(feats, {'beam_size': opt.beam_size, 'control_id': opt.control_id})
+            seq, logseq = model.sample(feats, {'beam_size': opt.beam_size, 'control_ids': decode_control_ids})
+            decode_time += time.time() - t_start
             logger.info("Inference time: %f, batch_size: %d" % ((time.time() - t_start) / batch_size, batch_size))#-----修改
-            
-            sents = utils.decode_sequence(opt.vocab, seq)
-            if opt.output_logp == 1:
-                test_avglogp = utils.compute_avglogp(seq, logseq)
-                test_avglogps.extend(test_avglogp)
 
-            for jj, sent in enumerate(sents):
+            # the captions of the ci-th control id are in the ci-th block of rows
+            num_rows = feats[0].size(0)
+            for ci in range(len(decode_control_ids)):
+                seq_ci = seq[ci * num_rows:(ci + 1) * num_rows]
+                sents = utils.decode_sequence(opt.vocab, seq_ci)
                 if opt.output_logp == 1:
-                    entry = {'image_id': data['ids'][jj], 'caption': sent, 'avglogp': test_avglogp[jj]}
-                else:
-                    entry = {'image_id': data['ids'][jj], 'caption': sent}
-                predictions.append(entry)
-                logger.debug('[%d] video %s: %s' % (jj, entry['image_id'], entry['caption']))
-
-    # loss = round(loss_sum / num_iters, 3)
-    results = {}
-    lang_stats = {}
-
-    if opt.language_eval == 1 and loader.has_label:
-        logger.info('>>> Language evaluating ...')
-        tmp_checkpoint_json = os.path.join(opt.model_file + str(uuid.uuid4()) + '.json')
-        json.dump(predictions, open(tmp_checkpoint_json, 'w'))
-        lang_stats = utils.language_eval(loader.cocofmt_file, tmp_checkpoint_json)
-        os.remove(tmp_checkpoint_json)
-
-    results['predictions'] = predictions
-    # results['scores'] = {'Loss': -loss}
-    # results['scores'].update(lang_stats)
-    results['scores'] = lang_stats
+                    test_avglogp = utils.compute_avglogp(seq_ci, logseq[ci * num_rows:(ci + 1) * num_rows])
+                    test_avglogps[ci].extend(test_avglogp)
+
+                for jj, sent in enumerate(sents):
+                    if opt.output_logp == 1:
+                        entry = {'image_id': data['ids'][jj], 'caption': sent, 'avglogp': test_avglogp[jj]}
+                    else:
+                        entry = {'image_id': data['ids'][jj], 'caption': sent}
+                    predictions[ci].append(entry)
+                    logger.debug('[%d] video %s: %s' % (jj, entry['image_id'], entry['caption']))
+
+    if isinstance(loader, BatchPrefetcher):
+        logger.info('Loader wait time: %f', loader.pop_wait_time())
+
+    all_results = []
+    for ci in range(len(decode_control_ids)):
+        # loss = round(loss_sum / num_iters, 3)
+        results = {}
+        lang_stats = {}
+
+        if opt.language_eval == 1 and loader.has_label:
+            logger.info('>>> Language evaluating ...')
+            tmp_checkpoint_json = os.path.join(opt.model_file + str(uuid.uuid4()) + '.json')
+            json.dump(predictions[ci], open(tmp_checkpoint_json, 'w'))
+            lang_stats = utils.language_eval(loader.cocofmt_file, tmp_checkpoint_json)
+            os.remove(tmp_checkpoint_json)
+
+        results['predictions'] = predictions[ci]
+        # results['scores'] = {'Loss': -loss}
+        # results['scores'].update(lang_stats)
+        results['scores'] = lang_stats
+        # of all the control ids decoded together
+        results['decode_time'] = decode_time
+
+        if opt.output_logp == 1:
+            avglogp = sum(test_avglogps[ci]) / float(len(test_avglogps[ci]))
+            results['scores'].update({'avglogp': avglogp})
+        all_results.append(results)
 
     if opt.output_logp == 1:
-        avglogp = sum(test_avglogps) / float(len(test_avglogps))
-        results['scores'].update({'avglogp': avglogp})
-
         gt_avglogps = np.array(gt_avglogps).reshape(-1, seq_per_img)
         assert num_videos == gt_avglogps.shape[0]
 
@@ -343,7 +452,7 @@ def validate(model, criterion, loader, opt):
 
         logger.info('Wrote GT logp to: %s', gt_avglogps_file)
 
-    return results
+    return all_results if control_ids else all_results[0]
 
 
 def test(model, criterion, loader, opt):
@@ -354,6 +463,22 @@ def test(model, criterion, loader, opt):
     logger.info('Wrote output caption to: %s ', opt.result_file)
 
 
+def test_controls(model, criterion, loader, opt):
+    """Decode the test set once for all of opt.control_ids and report every
+    control id as test() does; the result file maps the control names to the
+    results.
+    """
+    all_results = validate(model, criterion, loader, opt, control_ids=opt.control_ids)
+    for control_id, results in zip(opt.control_ids, all_results):
+        logger.info('-' * 5 + '%s result' % CONTROL_NAMES.get(control_id, control_id) + '-' * 5)
+        logger.info('Test output: %s', json.dumps(results['scores'], indent=4))
+
+    json.dump({CONTROL_NAMES.get(control_id, str(control_id)): results for control_id, results in zip(opt.control_ids, all_results)},
+              open(opt.result_file, 'w'))
+    logger.info('Wrote output caption to: %s ', opt.result_file)
+    return all_results
+
+
 if __name__ == '__main__':
 
     opt = opts.parse_opts() # 参数设置
@@ -362,17 +487,26 @@ if __name__ == '__main__':
 
     logger.info('Input arguments: %s', json.dumps(vars(opt), sort_keys=True, indent=4))
 
+    # the reward workers of pipelined RL are started before CUDA and the loader threads
+    # (see utils.RewardPool), and get their scorer when RL starts
+    reward_pool = None
+    if opt.use_rl == 1 and opt.reward_workers > 0 and not opt.use_dxe:
+        reward_pool = utils.RewardPool(opt.reward_workers)
+
     # Set the random seed manually for reproducibility.
     np.random.seed(opt.seed)
     torch.manual_seed(opt.seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(opt.seed)
+    utils.setup_device(opt)
+    logger.info('Running on: %s', opt.device)
 
     train_opt = {'label_h5': opt.train_label_h5,
                  'batch_size': opt.batch_size,
                  'feat_h5': opt.train_feat_h5,
                  'cocofmt_file': opt.train_cocofmt_file,
                  'bcmrscores_pkl': opt.train_bcmrscores_pkl,
+                 'control_h5': opt.train_control_h5,
                  'eval_metric': opt.eval_metric,
                  'seq_per_img': opt.train_seq_per_img,
                  'num_chunks': opt.num_chunks,
@@ -383,6 +517,9 @@ if __name__ == '__main__':
                  'use_long_range': opt.use_long_range,
                  'use_short_range': opt.use_short_range,
                  'use_local': opt.use_local,
+                 'bulk_read': opt.bulk_read,
+                 'feat_backend': opt.feat_backend,
+                 'bucket_batches': opt.bucket_batches,
                  'mode': 'train'
                  }
 
@@ -399,6 +536,8 @@ if __name__ == '__main__':
                'use_long_range': opt.use_long_range,
                'use_short_range': opt.use_short_range,
                'use_local': opt.use_local,
+               'bulk_read': opt.bulk_read,
+               'feat_backend': opt.feat_backend,
                'mode': 'test'
                }
 
@@ -415,6 +554,8 @@ if __name__ == '__main__':
                 'use_long_range': opt.use_long_range,
                 'use_short_range': opt.use_short_range,
                 'use_local': opt.use_local,
+                'bulk_read': opt.bulk_read,
+                'feat_backend': opt.feat_backend,
                 'mode': 'test'
                 }
 
@@ -422,6 +563,15 @@ if __name__ == '__main__':
     val_loader = DataLoader(val_opt)
     test_loader = DataLoader(test_opt)
 
+    if opt.num_workers > 0:
+        train_loader = WorkerBatchLoader(train_loader, opt.num_workers)
+        val_loader = WorkerBatchLoader(val_loader, opt.num_workers)
+        test_loader = WorkerBatchLoader(test_loader, opt.num_workers)
+    elif opt.prefetch_batches > 0:
+        train_loader = BatchPrefetcher(train_loader, opt.prefetch_batches)
+        val_loader = BatchPrefetcher(val_loader, opt.prefetch_batches)
+        test_loader = BatchPrefetcher(test_loader, opt.prefetch_batches)
+
     opt.vocab = train_loader.get_vocab()
     opt.vocab_size = train_loader.get_vocab_size()
     opt.seq_length = train_loader.get_seq_length()
@@ -433,26 +583,30 @@ if __name__ == '__main__':
 
     xe_criterion = CrossEntropyCriterion()
     rl_criterion = RewardCriterion()
-    #---------新增加---------
-    xe_criterion2 = CrossEntropyCriterion2()
-    xe_criterion3 = CrossEntropyCriterion3()
-    xe_criterion4 = CrossEntropyCriterion4()
-
-    if torch.cuda.is_available():
-        model.cuda()
-        xe_criterion.cuda()
-        rl_criterion.cuda()
-        #-------新增------
-        xe_criterion2.cuda()
-        xe_criterion3.cuda()
-        xe_criterion4.cuda()
+    assert opt.lazy_expand == 0 or opt.factorized_core == 1, '--lazy_expand needs --factorized_core 1'
+    fused_criterion = None
+    if opt.fused_xe == 1 and opt.fuse_streams == 1 and opt.model_type != 'standard':
+        word_counts = train_loader.get_word_counts() if opt.num_sampled > 0 else None
+        fused_criterion = MultiStreamCriterion(opt.xe_chunk_size, num_sampled=opt.num_sampled, word_counts=word_counts)
+        fused_criterion.to(opt.device)
+    assert opt.num_sampled == 0 or fused_criterion is not None, '--num_sampled needs --fused_xe 1 and --fuse_streams 1'
+    if opt.stream_probs:
+        assert fused_criterion is not None, '--stream_probs needs --fused_xe 1 and --fuse_streams 1'
+        assert len(opt.stream_probs) == 4, 'expected one probability per control stream'
+        opt.stream_probs = [p / sum(opt.stream_probs) for p in opt.stream_probs]
+
+    model.to(opt.device)
+    xe_criterion.to(opt.device)
+    rl_criterion.to(opt.device)
 
     logger.info('Start training...')
     start = datetime.now()
 
     optimizer = optim.Adam(model.parameters(), lr=opt.learning_rate)
     #---修改----
-    infos = train(model, xe_criterion, optimizer, train_loader, val_loader, opt, xe_criterion2,xe_criterion3,xe_criterion4,rl_criterion=rl_criterion)
+    infos = train(model, xe_criterion, optimizer, train_loader, val_loader, opt, rl_criterion=rl_criterion, fused_criterion=fused_criterion, worker_pool=reward_pool)
+    if reward_pool is not None:
+        reward_pool.close()
     logger.info(
         'Best val %s score: %f. Best iter: %d. Best epoch: %d',
         opt.eval_metric,
@@ -467,32 +621,12 @@ if __name__ == '__main__':
         start = datetime.now()
 
         logger.info('Loading model: %s', opt.model_file)
-        checkpoint = torch.load(opt.model_file)
+        checkpoint = torch.load(opt.model_file, map_location=opt.device)
         model.load_state_dict(checkpoint['model'])
 
         # test(model, xe_criterion, test_loader, opt)
         #-----------新增代码-----------
-        logger.info('-' * 5 + 'short result' + '-' * 5)
-        opt.control_id = 1
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'middle result' + '-' * 5)
-        opt.control_id = 2
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'long result' + '-' * 5)
-        opt.control_id = 3
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'single-object result' + '-' * 5)
-        opt.control_id = 4
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'multi-object result' + '-' * 5)
-        opt.control_id = 5
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'single-action result' + '-' * 5)
-        opt.control_id = 6
-        test(model, xe_criterion, test_loader, opt)
-        logger.info('-' * 5 + 'multi-action result' + '-' * 5)
-        opt.control_id = 7
-        test(model, xe_criterion, test_loader, opt)
+        test_controls(model, xe_criterion, test_loader, opt)
 
         #-----------------------------
         logger.info('Testing time: %s', datetime.now() - start)
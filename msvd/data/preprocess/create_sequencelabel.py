@@ -88,11 +88,13 @@ def main(vocab_json, captions_json, output_h5, max_length):
             logger.info('Encoding captions...')
             L, label_start_ix, label_end_ix, label_length, label_to_video = encode_captions(videos, max_length, wtoi)
 
-            of.create_dataset('labels', dtype=int, data=L)
-            of.create_dataset('label_start_ix', dtype=int, data=label_start_ix)
-            of.create_dataset('label_end_ix', dtype=int, data=label_end_ix)
-            of.create_dataset('label_length', dtype=int, data=label_length)
-            of.create_dataset('label_to_video', dtype=int, data=label_to_video)
+            # compact storage: word ids as uint16 when the vocab fits, pointers as int32
+            label_dtype = np.uint16 if len(vocab) <= np.iinfo(np.uint16).max + 1 else int
+            of.create_dataset('labels', dtype=label_dtype, data=L)
+            of.create_dataset('label_start_ix', dtype=np.int32, data=label_start_ix)
+            of.create_dataset('label_end_ix', dtype=np.int32, data=label_end_ix)
+            of.create_dataset('label_length', dtype=np.int32, data=label_length)
+            of.create_dataset('label_to_video', dtype=np.int32, data=label_to_video)
         else:
             logger.info('Caption not found! Skipped encoding captions.')
 
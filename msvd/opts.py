@@ -12,9 +12,11 @@ def parse_opts():
     parser.add_argument('--train_feat_h5', type=str, nargs='+', help='path to the h5 file containing extracted features')
     parser.add_argument('--val_feat_h5', type=str, nargs='+', help='path to the h5 file containing extracted features')
     parser.add_argument('--test_feat_h5', type=str, nargs='+', help='path to the h5 file containing extracted features')
+    parser.add_argument('--feat_backend', type=str, default='h5', choices=['h5', 'mmap'], help='h5: read the feature h5 files, mmap: read the stores converted from them by data/preprocess/convert_feats2mmap.py (foo.h5 -> foo.json + foo.bin)')
     parser.add_argument('--train_cocofmt_file', type=str, help='Gold captions in MSCOCO format to cal language metrics')
     parser.add_argument('--val_cocofmt_file', type=str, help='Gold captions in MSCOCO format to cal language metrics')
     parser.add_argument('--test_cocofmt_file', type=str, help='Gold captions in MSCOCO format to cal language metrics')
+    parser.add_argument('--train_control_h5', type=str, default=None, help='h5 file with the noun/verb control ids of the training captions, written by data/preprocess/create_controllabel.py. Default: --train_label_h5')
     parser.add_argument('--train_bcmrscores_pkl', type=str, help='Pre-computed Cider-D metric for all captions')
     # Optimization: General
     parser.add_argument('--max_patience', type=int, default=100, help='max number of epoch to run since the minima is detected -- early stopping')
@@ -43,8 +45,12 @@ def parse_opts():
     parser.add_argument('--use_dxe', type=int, default=0, help='Use DXE training or not')
     parser.add_argument('--use_rl', type=int, default=0, help='Use RL training or not')
     parser.add_argument('--use_rl_after', type=int, default=0, help='Start RL training after this epoch')
+    parser.add_argument('--fast_cider', type=int, default=1, help='If 1, compute the CIDEr rewards on token ids with utils.CiderDReward (same scores as CiderD), caching the reference vectors of each training video')
+    parser.add_argument('--reward_workers', type=int, default=0, help='If > 0, pipeline RL training: the rewards of a batch are computed in this many worker processes while the next batches are rolled out, and the model learns from the rollouts of --reward_staleness steps ago. The scoring time and the part of it the loop waited for are logged as RewardTime and RewardWait')
+    parser.add_argument('--reward_staleness', type=int, default=1, help='With --reward_workers, number of rollouts being scored while the model learns from the oldest one (0: wait for the rewards of the current batch)')
     parser.add_argument('--train_cached_tokens', type=str, default=30, help='Path to idx document frequencies to cal Cider on training data')
     parser.add_argument('--expand_feat', type=int, default=1, help='To expand features when sampling (to multiple captions)')
+    parser.add_argument('--sample_check_every', type=int, default=4, help='When sampling the SCST baseline, check whether all the captions ended only every this many steps (0: only at the last step), to avoid syncing with the GPU at every step; the captions are cut back to the step a check at every step (1) would have stopped at, so only the number of steps run changes')
     parser.add_argument('--model_file', type=str, help='output model file')
     parser.add_argument('--result_file', type=str, help='output result file')
     parser.add_argument('--start_from', type=str, default='', help='Load state from this file to continue training')
@@ -55,11 +61,19 @@ def parse_opts():
     parser.add_argument('--loglevel', type=str, default='DEBUG', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
     # misc
     parser.add_argument('--seed', type=int, default=123, help='random number generator seed to use')
+    parser.add_argument('--device', type=str, default='auto', help='device to run on: auto (cuda when available), cpu, cuda or cuda:N')
+    parser.add_argument('--num_threads', type=int, default=0, help='On the CPU, number of intra-op threads (0: torch default)')
+    parser.add_argument('--num_interop_threads', type=int, default=0, help='On the CPU, number of inter-op threads (0: torch default; needs torch >= 1.2)')
     parser.add_argument('--gpuid', type=int, default=7, help='which gpu to use. -1 = use CPU')
     parser.add_argument('--num_chunks', type=int, default=1, help='1: no attention, > 1: attention with num_chunks')
     parser.add_argument('--num_layers', type=int, default=1, help='number of layers in the lstm ')
     parser.add_argument('--model_type', type=str, default='concat', choices=['standard', 'concat', 'manet', ], help='Type of models')
+    parser.add_argument('--fuse_streams', type=int, default=0, help='If 1, run the control streams of the XE forward as one batched RNN step (concat/manet models); 0 runs one step per stream. Teacher-forced concat models (no scheduled sampling or MIXER) always run all the streams over whole packed sequences')
+    parser.add_argument('--factorized_core', type=int, default=0, help='If 1, one-layer concat models step the RNN cell with the video part of its input projection computed once per video, instead of at every step')
+    parser.add_argument('--lazy_expand', type=int, default=0, help='If 1, concat models keep one row of video features per video in the XE forward and broadcast it to the seq_per_img captions where used, instead of expanding the features up front. Needs --factorized_core 1, and only the stepwise loop benefits (scheduled sampling, MIXER/RL): the teacher-forced packed path builds the expanded features into its input sequence')
     parser.add_argument('--beam_size', type=int, default=5, help='Beam search size')
+    parser.add_argument('--export_file', type=str, default='', help='If set, test.py saves the decoder of the model as a TorchScript file (see model.export_decoder) instead of testing it')
+    parser.add_argument('--quantize', type=int, default=0, help='If 1, test.py (on the CPU) also decodes with a dynamic int8 copy of the model, and reports its score deltas, decoding time and weight size against the float model')
     parser.add_argument('--use_ss', type=int, default=0, help='Use schedule sampling')
     parser.add_argument('--use_ss_after', type=int, default=0, help='Use schedule sampling after this epoch')
     parser.add_argument('--ss_max_prob', type=float, default=0.25, help='Use schedule sampling')
@@ -85,10 +99,19 @@ def parse_opts():
     parser.add_argument('--use_long_range', type=int, default=1, help=' If 1, then use long range feature')
     parser.add_argument('--use_short_range', type=int, default=1, help=' If 1, then use short range feature')
     parser.add_argument('--use_local', type=int, default=1, help=' If 1, then use local keyframe feature')
+    parser.add_argument('--prefetch_batches', type=int, default=0, help='If > 0, build this many batches ahead in a background thread. The time the training loop waited for batches is logged as LoaderWait')
+    parser.add_argument('--num_workers', type=int, default=0, help='If > 0, build the batches in this many worker processes with torch.utils.data.DataLoader (overrides --prefetch_batches). The time the training loop waited for batches is logged as LoaderWait')
+    parser.add_argument('--bulk_read', type=int, default=1, help='If 1, read the features of a batch with one sorted h5 call per file, instead of one call per video')
+    parser.add_argument('--bucket_batches', type=int, default=0, help='If > 0, group the training videos into batches of similar longest caption length, sorting runs of this many shuffled batches; labels and masks are trimmed to the longest caption of each batch')
     #------新增----------
     parser.add_argument('--control_id', type=int, default=0)
+    parser.add_argument('--control_ids', type=int, nargs='+', default=[1, 2, 3, 4, 5], help='control ids decoded together at test time, each reported separately')
     parser.add_argument('--lamba1', type=float, default=1.0)
     parser.add_argument('--lamba2', type=float, default=1.0)
     parser.add_argument('--lamba3', type=float, default=1.0)
+    parser.add_argument('--fused_xe', type=int, default=0, help='If 1 (with --fuse_streams 1 and a concat/manet model), score all the control streams with one criterion from the hidden states, projecting to the vocabulary a chunk of tokens at a time, instead of from the full log probabilities of every stream')
+    parser.add_argument('--stream_probs', type=float, nargs='+', default=None, help='If given, one probability per control stream (length, ada, noun): XE training runs each caption through a single stream drawn with these probabilities instead of all of them, its loss scaled by lamba/probability so that the expected loss is that of all the streams (needs --fused_xe 1)')
+    parser.add_argument('--num_sampled', type=int, default=0, help='If > 0 (with --fused_xe), train with a sampled softmax over the words of each batch plus this many words drawn from the unigram^0.75 distribution of the training captions; validation and beam search still score the whole vocabulary')
+    parser.add_argument('--xe_chunk_size', type=int, default=2048, help='Number of tokens projected to the vocabulary at a time by --fused_xe')
     args = parser.parse_args()
     return args
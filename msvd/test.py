@@ -7,13 +7,14 @@ import sys
 import time
 import math
 import json
+import io
 
 import logging
 from datetime import datetime
 
-from dataloader import DataLoader
-from model import CaptionModel, CrossEntropyCriterion
-from train import test
+from dataloader import DataLoader, BatchPrefetcher, WorkerBatchLoader
+from model import CaptionModel, CrossEntropyCriterion, quantize_dynamic, export_decoder
+from train import test_controls, CONTROL_NAMES
 
 import utils
 import opts
@@ -62,6 +63,39 @@ def download_file_from_google_drive(file_id, destination):
 
     save_response_content(response, destination)
 
+def weight_size(model):
+    """Size in bytes of the serialized state dict"""
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def test_quantized(model, criterion, loader, opt):
+    """Test the float model, then its dynamic int8 copy (see quantize_dynamic),
+    and report the score deltas, decoding times and weight sizes of the int8
+    model; the result file holds the int8 results. Both models run the RNN core
+    itself, not the factorized step, so that the decoding times compare the same
+    implementation.
+    """
+    factorized, model.core.factorized = model.core.factorized, False
+    float_size = weight_size(model)
+    logger.info('Testing the float model...')
+    float_results = test_controls(model, criterion, loader, opt)
+
+    qmodel = quantize_dynamic(model)
+    model.core.factorized = factorized
+    int8_size = weight_size(qmodel)
+    logger.info('Testing the int8 model...')
+    int8_results = test_controls(qmodel, criterion, loader, opt)
+
+    for control_id, fr, qr in zip(opt.control_ids, float_results, int8_results):
+        deltas = {k: round(qr['scores'][k] - fr['scores'][k], 5) for k in fr['scores'] if k in qr['scores']}
+        logger.info('%s int8 - float scores: %s', CONTROL_NAMES.get(control_id, control_id), json.dumps(deltas, sort_keys=True))
+    float_time, int8_time = float_results[0]['decode_time'], int8_results[0]['decode_time']
+    logger.info('Decoding time: float %.2fs, int8 %.2fs (%.2fx)', float_time, int8_time, float_time / max(int8_time, 1e-6))
+    logger.info('Weight size: float %.1fMB, int8 %.1fMB', float_size / 1e6, int8_size / 1e6)
+
+
 ID_DICT = {'GL-RG_XE_msrvtt': '1xaAW-hUbOiXv5kdMxO-gCLAgl-wkre8q',
            'GL-RG_DXE_msrvtt': '1Jx1sCU2aQt0AA5-dRfRZallsCnbYB1Ud',
            'GL-RG_DR_msrvtt': '1x8Mh7HJuCmAWjwNExOR8MXqFCNyYttyJ',
@@ -79,6 +113,9 @@ if __name__ == '__main__':
 
     logger.info('Input arguments: %s', json.dumps(vars(opt), sort_keys=True, indent=4))
 
+    utils.setup_device(opt)
+    logger.info('Running on: %s', opt.device)
+
     start = datetime.now()
 
     # test_opt = {'label_h5': opt.test_label_h5,
@@ -102,10 +139,16 @@ if __name__ == '__main__':
                 'use_long_range': opt.use_long_range,
                 'use_short_range': opt.use_short_range,
                 'use_local': opt.use_local,
+                'bulk_read': opt.bulk_read,
+                'feat_backend': opt.feat_backend,
                 'mode': 'test'
                 }
 
     test_loader = DataLoader(test_opt)
+    if opt.num_workers > 0:
+        test_loader = WorkerBatchLoader(test_loader, opt.num_workers)
+    elif opt.prefetch_batches > 0:
+        test_loader = BatchPrefetcher(test_loader, opt.prefetch_batches)
 
     if not os.path.exists(opt.model_file):
         logger.info('cannot find model in path: %s ', opt.model_file)
@@ -117,7 +160,7 @@ if __name__ == '__main__':
         download_file_from_google_drive(ID_DICT[model_name], opt.model_file)
 
     logger.info('Loading model: %s', opt.model_file)
-    checkpoint = torch.load(opt.model_file)
+    checkpoint = torch.load(opt.model_file, map_location=opt.device)
     checkpoint_opt = checkpoint['opt']
 
     opt.model_type = checkpoint_opt.model_type
@@ -137,27 +180,21 @@ if __name__ == '__main__':
 
     xe_criterion = CrossEntropyCriterion()
 
-    if torch.cuda.is_available():
-        model.cuda()
-        xe_criterion.cuda()
-
-    logger.info('Start testing...')
-    # test(model, xe_criterion, test_loader, opt)
-    #---------新增代码---------
-    logger.info('-' * 5 + 'short result' + '-' * 5)
-    opt.control_id = 1
-    test(model, xe_criterion, test_loader, opt)
-    logger.info('-' * 5 + 'middle result' + '-' * 5)
-    opt.control_id = 2
-    test(model, xe_criterion, test_loader, opt)
-    logger.info('-' * 5 + 'long result' + '-' * 5)
-    opt.control_id = 3
-    test(model, xe_criterion, test_loader, opt)
-    logger.info('-' * 5 + 'single-object result' + '-' * 5)
-    opt.control_id = 4
-    test(model, xe_criterion, test_loader, opt)
-    logger.info('-' * 5 + 'multi-object result' + '-' * 5)
-    opt.control_id = 5
-    test(model, xe_criterion, test_loader, opt)
+    model.to(opt.device)
+    xe_criterion.to(opt.device)
+
+    if opt.export_file:
+        logger.info('Exporting the decoder to: %s', opt.export_file)
+        feats = [feat.to(opt.device) for feat in test_loader.get_batch()['feats']]
+        export_decoder(model, feats, opt.export_file, meta={'vocab': opt.vocab, 'control_names': CONTROL_NAMES})
+    else:
+        logger.info('Start testing...')
+        # test(model, xe_criterion, test_loader, opt)
+        #---------新增代码---------
+        if opt.quantize == 1:
+            assert opt.device == 'cpu', 'the int8 kernels run on the CPU only, use --device cpu'
+            test_quantized(model, xe_criterion, test_loader, opt)
+        else:
+            test_controls(model, xe_criterion, test_loader, opt)
     #------------------------
     logger.info('Time: %s', datetime.now() - start)
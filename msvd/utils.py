@@ -1,11 +1,14 @@
 import sys
 import os
 import json
+import time
+import multiprocessing
 
 import cPickle
 
 import numpy as np
-from collections import OrderedDict
+import torch
+from collections import OrderedDict, deque
 
 sys.path.append("cider")
 from pyciderevalcap.ciderD.ciderD import CiderD
@@ -19,6 +22,20 @@ from pycocoevalcap.rouge.rouge import Rouge
 from pycocoevalcap.meteor.meteor import Meteor
 
 
+def setup_device(opt):
+    """Resolve opt.device ('auto': cuda when available, else cpu) and, on the
+    CPU, apply the --num_threads / --num_interop_threads thread counts
+    """
+    if opt.device == 'auto':
+        opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if opt.device == 'cpu':
+        if opt.num_threads > 0:
+            torch.set_num_threads(opt.num_threads)
+        if opt.num_interop_threads > 0 and hasattr(torch, 'set_num_interop_threads'):
+            torch.set_num_interop_threads(opt.num_interop_threads)
+    return opt.device
+
+
 def get_discriminative_cross_entropy_scores(model_res, bcmrscores=None):
     """
     Arguments:
@@ -36,17 +53,26 @@ def get_discriminative_cross_entropy_scores(model_res, bcmrscores=None):
     return rewards, m_score, b_score
 
 
-def get_self_critical_reward(model_res, scst_res, data_gts, bcmr_scorer, expand_feat=0, seq_per_img=20, use_eos=0):
+def get_self_critical_reward(model_res, scst_res, data_gts, bcmr_scorer, expand_feat=0, seq_per_img=20, use_eos=0, video_ids=None):
     """
     SCST baseline:
         Self-critical Sequence Training for Image Captioning (CVPR'17) 
         Paper: https://arxiv.org/pdf/1612.00563.pdf
+    With a CiderDReward scorer (built with use_eos), the sequences are scored as
+    token ids, the references cached by video_ids.
     """
     batch_size = model_res.size(0)
 
     model_res = model_res.cpu().numpy()
     scst_res = scst_res.cpu().numpy()
 
+    if isinstance(bcmr_scorer, CiderDReward):
+        video_ix = np.arange(2 * batch_size) % batch_size
+        if expand_feat == 1:
+            video_ix = video_ix // seq_per_img
+        scores = bcmr_scorer.compute_scores(list(model_res) + list(scst_res), data_gts, video_ix, video_ids=video_ids)
+        return get_self_critical_scores(scores, batch_size, model_res.shape[1])
+
     res = OrderedDict()
     for i in range(batch_size):
         res[i] = [array_to_str(model_res[i], use_eos)]
@@ -76,25 +102,43 @@ def get_self_critical_reward(model_res, scst_res, data_gts, bcmr_scorer, expand_
     if type(scores) == list:
         scores = np.array(scores)
 
+    return get_self_critical_scores(scores, batch_size, model_res.shape[1])
+
+
+def get_self_critical_scores(scores, batch_size, seq_length):
+    """Rewards of the first batch_size scores against the next batch_size (baseline) ones"""
     m_score = np.mean(scores[:batch_size])
     g_score = np.mean(scores[batch_size:])
 
     scores = scores[:batch_size] - scores[batch_size:]
 
-    rewards = np.repeat(scores[:, np.newaxis], model_res.shape[1], 1)
+    rewards = np.repeat(scores[:, np.newaxis], seq_length, 1)
 
     return rewards, m_score, g_score
 
 
-def get_discrepant_reward(model_res, data_gts, bcmr_scorer, bcmrscores=None, expand_feat=0, seq_per_img=20, dr_baseline_captions=20, dr_baseline_type=1, use_eos=0, use_mixer=0):
+def get_discrepant_reward(model_res, data_gts, bcmr_scorer, bcmrscores=None, expand_feat=0, seq_per_img=20, dr_baseline_captions=20, dr_baseline_type=1, use_eos=0, use_mixer=0, video_ids=None):
     """
     Arguments:
         bcmrscores: precomputed scores (BLEU, CIDEr, METEOR, ROUGE_L) of GT sequences
         dr_baseline_type: 1 - use GT sentences to compute baseline, 
                           2 - use sampled sentences to compute baseline.
+        video_ids: ids of the videos of data_gts, to cache their references in a
+                   CiderDReward scorer
     """
 
-    if bcmrscores is None or use_mixer == 1:
+    if (bcmrscores is None or use_mixer == 1) and isinstance(bcmr_scorer, CiderDReward):
+        batch_size = model_res.size(0)
+
+        model_res = model_res.cpu().numpy()
+
+        video_ix = np.arange(batch_size)
+        if expand_feat == 1:
+            video_ix = video_ix // seq_per_img
+        scores = bcmr_scorer.compute_scores(model_res, data_gts, video_ix, video_ids=video_ids)
+        scores = scores.reshape(-1, seq_per_img)
+
+    elif bcmrscores is None or use_mixer == 1:
         batch_size = model_res.size(0)
 
         model_res = model_res.cpu().numpy()
@@ -300,3 +344,199 @@ def array_to_str(arr, use_eos=0):
 
     return out.strip()
 
+
+
+class CiderDReward(object):
+    """
+    CIDEr-D of token-id sequences, the same as CiderD(df=df_file).compute_score on
+    their array_to_str strings, without building the strings. The n-grams are
+    encoded as int64 keys, the references of a video are turned into tf-idf
+    vectors once (the first time it is scored, given its id), and all the
+    sequences of a video are scored against all its references at once.
+    """
+
+    def __init__(self, df_file, vocab_size, n=4, sigma=6.0, use_eos=0):
+        self.n = n
+        self.sigma = sigma
+        self.use_eos = use_eos
+        # an n-gram is the base (vocab_size + 1) number of its word ids + 1
+        self.base = vocab_size + 1
+        assert float(self.base) ** n < 2 ** 63, 'too many words to encode the %d-grams' % n
+
+        # document frequencies of the n-grams (tuples of word id strings), see compute_ciderdf.py
+        pkl_file = cPickle.load(open(df_file, 'r'))
+        self.ref_len = np.log(float(pkl_file['ref_len']))
+        df = pkl_file['document_frequency']
+        keys = np.array([self.ngram_key(ngram) for ngram in df], dtype=np.int64)
+        order = np.argsort(keys)
+        self.df_keys = keys[order]
+        self.df_log = np.log(np.maximum(1.0, np.array(list(df.values()), dtype=np.float64)[order]))
+
+        self.refs = {}
+
+    def ngram_key(self, ngram):
+        key = 0
+        for w in ngram:
+            key = key * self.base + int(w) + 1
+        return key
+
+    def log_df(self, keys):
+        if len(self.df_keys) == 0:
+            return np.zeros(len(keys))
+        idx = np.searchsorted(self.df_keys, keys).clip(max=len(self.df_keys) - 1)
+        return np.where(self.df_keys[idx] == keys, self.df_log[idx], 0.0)
+
+    def words(self, seq):
+        """The word ids of seq kept by array_to_str"""
+        seq = np.asarray(seq, dtype=np.int64)
+        ends = np.flatnonzero(seq == 0)
+        if len(ends) > 0:
+            seq = seq[:ends[0] + 1] if self.use_eos else seq[:ends[0]]
+        return seq[seq != 1]
+
+    def vectorize(self, words):
+        """Keys, orders (n - 1) and tf-idf values of the n-grams of `words`, with the
+        norm of each order and the length (number of bigrams) CiderD uses
+        """
+        keys = []
+        key = np.zeros(len(words) + 1, dtype=np.int64)
+        for k in range(self.n):
+            # key[i] encodes words[i:i + k + 1]
+            key = key[:max(len(words) - k, 0)] * self.base + words[k:] + 1
+            keys.append(key)
+        orders = np.concatenate([np.full(len(key), k, dtype=np.int64) for k, key in enumerate(keys)])
+        keys, index, counts = np.unique(np.concatenate(keys), return_index=True, return_counts=True)
+        orders = orders[index]
+
+        vec = counts * (self.ref_len - self.log_df(keys))
+        norm = np.sqrt(np.bincount(orders, weights=vec ** 2, minlength=self.n))
+        return keys, orders, vec, norm, max(len(words) - 1, 0)
+
+    def cook_refs(self, refs):
+        """The sorted n-gram keys of the references of a video, the keys x refs
+        matrix of their tf-idf values, and the norms and lengths of the references
+        """
+        vecs = [self.vectorize(self.words(ref)) for ref in refs]
+        keys = np.unique(np.concatenate([v[0] for v in vecs]))
+        values = np.zeros((len(keys), len(vecs)))
+        for j, v in enumerate(vecs):
+            values[np.searchsorted(keys, v[0]), j] = v[2]
+        norms = np.array([v[3] for v in vecs])
+        lengths = np.array([v[4] for v in vecs], dtype=np.float64)
+        return keys, values, norms, lengths
+
+    def score_video(self, seqs, refs):
+        ref_keys, ref_values, ref_norms, ref_lengths = refs
+        if len(ref_keys) == 0:
+            return np.zeros(len(seqs))
+        vecs = [self.vectorize(self.words(seq)) for seq in seqs]
+        rows = np.concatenate([np.full(len(v[0]), i, dtype=np.int64) for i, v in enumerate(vecs)])
+        keys, orders, vec = [np.concatenate([v[j] for v in vecs]) for j in range(3)]
+        norms = np.array([v[3] for v in vecs])
+        lengths = np.array([v[4] for v in vecs], dtype=np.float64)
+
+        # tf-idf values of the n-grams of the sequences in every reference
+        idx = np.searchsorted(ref_keys, keys).clip(max=len(ref_keys) - 1)
+        vec_ref = ref_values[idx] * (ref_keys[idx] == keys)[:, None]
+
+        # clipped dot products, seqs x orders x refs
+        val = np.zeros((len(vecs), self.n, len(ref_lengths)))
+        np.add.at(val, (rows, orders), np.minimum(vec[:, None], vec_ref) * vec_ref)
+        denom = norms[:, :, None] * ref_norms.T[None]
+        nonzero = denom != 0
+        val[nonzero] /= denom[nonzero]
+        # gaussian length penalty
+        val *= np.exp(-(lengths[:, None] - ref_lengths[None]) ** 2 / (2 * self.sigma ** 2))[:, None]
+        return val.sum(2).mean(1) / len(ref_lengths) * 10.0
+
+    def compute_scores(self, seqs, data_gts, video_ix, video_ids=None):
+        """CIDEr-D of each sequence seqs[i] against the references data_gts[video_ix[i]].
+        With video_ids (of data_gts), the cooked references are kept by video id.
+        """
+        video_ix = np.asarray(video_ix)
+        scores = np.zeros(len(seqs))
+        for v in np.unique(video_ix):
+            rows = np.flatnonzero(video_ix == v)
+            if video_ids is None:
+                refs = self.cook_refs(data_gts[v])
+            else:
+                if video_ids[v] not in self.refs:
+                    self.refs[video_ids[v]] = self.cook_refs(data_gts[v])
+                refs = self.refs[video_ids[v]]
+            scores[rows] = self.score_video([seqs[i] for i in rows], refs)
+        return scores
+
+
+def get_reward_scorer(eval_metric, cached_tokens, vocab_size, use_eos=0, fast_cider=1):
+    """Scorer of the RL rewards for eval_metric (see --fast_cider)"""
+    if eval_metric == 'CIDEr' and fast_cider == 1:
+        return CiderDReward(cached_tokens, vocab_size, use_eos=use_eos)
+    return {'Bleu_4': Bleu, 'CIDEr': lambda: CiderD(df=cached_tokens), 'METEOR': Meteor, 'ROUGE_L': Rouge}[eval_metric]()
+
+
+# scorer of a RewardPool worker process, and the get_reward_scorer arguments it was built with
+reward_scorer = None
+reward_scorer_args = None
+
+
+def compute_reward(scorer_args, reward_fn, args, kwargs):
+    """Run the reward function named reward_fn with the scorer of the worker (built
+    from scorer_args on first use), returning its output and the time it took
+    """
+    global reward_scorer, reward_scorer_args
+    if scorer_args != reward_scorer_args:
+        reward_scorer = get_reward_scorer(*scorer_args)
+        reward_scorer_args = scorer_args
+    t_start = time.time()
+    rewards, m_score, g_score = globals()[reward_fn](*args, bcmr_scorer=reward_scorer, **kwargs)
+    return rewards, m_score, g_score, time.time() - t_start
+
+
+class RewardPool(object):
+    """
+    Computes rewards (get_self_critical_reward or get_discrepant_reward, without
+    their bcmr_scorer argument) in worker processes, each with its own scorer
+    (see get_reward_scorer, set with set_scorer), so that the scoring of a batch
+    overlaps with the training loop. The results are returned in the order of
+    submission.
+
+    The workers are spawned where the start method can be chosen (python 3).
+    Otherwise they are forked, and the pool must then be created before CUDA is
+    initialized and before any loader thread starts.
+    """
+
+    def __init__(self, num_workers):
+        context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        self.pool = context.Pool(num_workers)
+        self.scorer_args = None
+        self.pending = deque()
+        self.score_time = 0.
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.pending)
+
+    def set_scorer(self, *scorer_args):
+        """Score the next submissions with get_reward_scorer(*scorer_args)"""
+        self.scorer_args = scorer_args
+
+    def submit(self, reward_fn, *args, **kwargs):
+        assert self.scorer_args is not None, 'no scorer set'
+        self.pending.append(self.pool.apply_async(compute_reward, (self.scorer_args, reward_fn.__name__, args, kwargs)))
+
+    def get(self):
+        """Rewards of the oldest pending submission, waiting for them if needed"""
+        t_start = time.time()
+        rewards, m_score, g_score, score_time = self.pending.popleft().get()
+        self.wait_time += time.time() - t_start
+        self.score_time += score_time
+        return rewards, m_score, g_score
+
+    def pop_times(self):
+        """Time spent scoring in the workers, and waiting for their results, since the last call"""
+        times = self.score_time, self.wait_time
+        self.score_time, self.wait_time = 0., 0.
+        return times
+
+    def close(self):
+        self.pool.terminate()